@@ -0,0 +1,316 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "benchmark_results")
+REFACTORING_TYPES = [
+    "Extract Method", "Rename Variable", "Move Class", "Rename Method",
+    "Extract Variable", "Inline Method", "Change Return Type", "Pull Up Method"
+]
+REGRESSION_THRESHOLD = 1.2
+
+#SYNTHETIC REPOSITORY
+def make_synthetic_repo(path, commits, files_per_commit, diff_lines, authors, seed=0):
+    """
+    Create a git repository with a generated linear history using git
+    fast-import, which is quick even for tens of thousands of commits.
+    Every commit rewrites diff_lines lines in files_per_commit Java files.
+    """
+    rng = random.Random(seed)
+    subprocess.run(["git", "init", "--quiet", path], check=True)
+    file_count = max(files_per_commit * 4, 1)
+    contents = {f"src/File{i}.java": [f"int value{j} = {j};" for j in range(diff_lines * 2)] for i in range(file_count)}
+    start = 1_500_000_000
+
+    stream = []
+    for commit in range(commits):
+        author = f"Author {rng.randrange(authors)}"
+        date = start + commit * 3600 + rng.randrange(3600)
+        stream.append(f"commit refs/heads/master\nmark :{commit + 1}\n")
+        stream.append(f"author {author} <{author.replace(' ', '.')}@example.com> {date} +0000\n")
+        stream.append(f"committer {author} <{author.replace(' ', '.')}@example.com> {date} +0000\n")
+        message = f"Commit {commit}"
+        stream.append(f"data {len(message)}\n{message}\n")
+        if commit > 0:
+            stream.append(f"from :{commit}\n")
+        for file in rng.sample(sorted(contents), min(files_per_commit, file_count)):
+            lines = contents[file]
+            for _ in range(diff_lines):
+                lines[rng.randrange(len(lines))] = f"int value{rng.randrange(10 ** 6)} = {commit};"
+            data = "class C {\n" + "\n".join(lines) + "\n}\n"
+            stream.append(f"M 100644 inline {file}\ndata {len(data.encode())}\n{data}\n")
+
+    subprocess.run(
+        ["git", "-C", path, "fast-import", "--quiet"],
+        input="".join(stream).encode(), check=True
+    )
+    subprocess.run(["git", "-C", path, "checkout", "--quiet", "master"], check=True)
+
+def make_rminer_fixture(repo_path, output_path, refactoring_ratio=0.5, seed=0):
+    """
+    Write a RefactoringMiner output for the synthetic repository, in the same
+    shape and order (newest commit first) as the real one
+    """
+    rng = random.Random(seed)
+    hashes = subprocess.run(
+        ["git", "-C", repo_path, "rev-list", "--all"], stdout=subprocess.PIPE, text=True, check=True
+    ).stdout.split()
+    commits = []
+    for commit_hash in hashes:
+        refactorings = []
+        if rng.random() < refactoring_ratio:
+            for _ in range(rng.randint(1, 5)):
+                refactorings.append({
+                    "type": rng.choice(REFACTORING_TYPES),
+                    "description": "Synthetic refactoring",
+                    "leftSideLocations": [],
+                    "rightSideLocations": []
+                })
+        commits.append({
+            "repository": repo_path,
+            "sha1": commit_hash,
+            "url": f"https://github.com/apache/synthetic/commit/{commit_hash}",
+            "refactorings": refactorings
+        })
+    with open(output_path, "w") as rminer_file:
+        json.dump({"commits": commits}, rminer_file)
+
+#STUB API SERVER
+class StubServer(ThreadingHTTPServer):
+    request_queue_size = 128 # Concurrent clients would otherwise wait on connect retries
+
+class StubApi(object):
+    """
+    Local stand-in for the GitHub and JIRA REST APIs, serving generated
+    issues so the issue stage can be measured without the network
+    """
+    def __init__(self, issue_count, page_delay=0.0):
+        self.issue_count = issue_count
+        self.page_delay = page_delay
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.page_delay)
+                status, body, headers = stub.route(self)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = StubServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def route(self, request):
+        url = urlparse(request.path)
+        query = parse_qs(url.query)
+        if url.path == "/jira/project":
+            return 200, [{"key": "SYNTH"}, {"key": "OTHER"}], {}
+        if url.path == "/jira/search":
+            start_at = int(query.get("startAt", ["0"])[0])
+            max_results = int(query.get("maxResults", ["50"])[0])
+            issues = [
+                {"key": f"SYNTH-{i + 1}", "fields": {"summary": f"Issue {i + 1}"}}
+                for i in range(start_at, min(start_at + max_results, self.issue_count))
+            ]
+            return 200, {"total": self.issue_count, "issues": issues}, {}
+        if match := re.fullmatch(r"/github/(\w+)/([\w-]+)/issues", url.path):
+            per_page = int(query.get("per_page", ["30"])[0])
+            page = int(query.get("page", ["1"])[0])
+            last_page = max(1, -(-self.issue_count // per_page))
+            issues = [
+                {"number": i + 1, "title": f"Issue {i + 1}"}
+                for i in range((page - 1) * per_page, min(page * per_page, self.issue_count))
+            ]
+            link = f'<{self.url}{url.path}?per_page={per_page}&page={last_page}>; rel="last"'
+            return 200, issues, {"Link": link, "ETag": f'"{page}-{self.issue_count}"'}
+        if match := re.fullmatch(r"/github/(\w+)/([\w-]+)", url.path):
+            # Repositories named *-jira have their issues in JIRA only
+            return (404, {}, {}) if match.group(2).endswith("-jira") else (200, {}, {})
+        return 404, {}, {}
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+#MEASUREMENT
+def measure(results, stage, function, *args):
+    """
+    Run function, storing its wall time and peak Python memory under stage
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[stage] = {"seconds": seconds, "peak_memory_bytes": peak}
+        print(f"{stage:>16}: {seconds:8.3f} s {peak / 1024 ** 2:8.1f} MiB")
+
+def run_benchmark(args, work_dir):
+    import main
+    import export
+    import issues
+    from catfile import CatFile
+    from diffstore import DiffStore
+    from nloc_cache import NlocCache
+
+    repo_path = os.path.join(work_dir, "synthetic")
+    output_dir = os.path.join(work_dir, "output")
+    os.makedirs(output_dir)
+    results = {}
+
+    print(f"Generating a repository with {args.commits} commits...")
+    make_synthetic_repo(repo_path, args.commits, args.files, args.diff_lines, args.authors, args.seed)
+    make_rminer_fixture(repo_path, os.path.join(output_dir, main.RMINER_OUTPUT_FILE), args.refactoring_ratio, args.seed)
+    nloc_cache = NlocCache(os.path.join(work_dir, "nloc.db"))
+
+    refactoring_hashes = measure(results, "parse", main.summarize_refactorings, repo_path, output_dir)
+    sample = refactoring_hashes[:args.date_sample]
+    measure(results, "commit_date", lambda: [main.get_commit_date(repo_path, h) for h in sample])
+    with CatFile(repo_path) as cat_file:
+        measure(results, "commit_date_batch", lambda: [main.get_commit_date(repo_path, h, cat_file) for h in sample])
+    measure(results, "commit_dates", lambda: list(export.read_commit_log(repo_path)))
+    measure(results, "diffs", main.collect_diffs, repo_path, refactoring_hashes, DiffStore(output_dir))
+    main.get_shared_cache = lambda: nloc_cache # Keep the benchmark away from the real cache
+    measure(results, "effort", main.collect_developer_effort, repo_path, output_dir, refactoring_hashes)
+    measure(results, "effort_cached", main.collect_developer_effort, repo_path, tempfile.mkdtemp(dir=work_dir), refactoring_hashes)
+    commits_dir = tempfile.mkdtemp(dir=work_dir)
+    measure(results, "commits", lambda: main.traverse(repo_path, [
+        main.DiffCollector(DiffStore(commits_dir), refactoring_hashes),
+        main.EffortCollector(repo_path, commits_dir, refactoring_hashes)
+    ]))
+    if args.processes > 1:
+        pool_dir = tempfile.mkdtemp(dir=work_dir)
+        measure(results, "diffs_pool", main.collect_diffs, repo_path, refactoring_hashes, DiffStore(pool_dir), args.processes)
+
+    with StubApi(args.issues, args.api_delay) as api:
+        issues.GITHUB_API_URL = f"{api.url}/github/"
+        issues.APACHE_JIRA_API_URL = f"{api.url}/jira"
+        issues.ETAG_CACHE_DIR = os.path.join(work_dir, "etags")
+        issues.JIRA_PROJECTS_CACHE_FILE = os.path.join(work_dir, "jira_projects.json")
+        issues.get_headers = lambda: {}
+        measure(results, "github_issues", issues.mine_issue_data, "https://github.com/apache/synth", output_dir)
+        measure(results, "github_etag", issues.mine_issue_data, "https://github.com/apache/synth", output_dir)
+        measure(results, "jira_issues", issues.mine_issue_data, "https://github.com/apache/synth-jira", output_dir)
+        results["api_requests"] = api.requests
+
+        urls = [f"https://github.com/apache/synth{i}" for i in range(args.issue_repos)]
+        measure(results, "issues_async", lambda: asyncio.run(collect_issues_async(api.url, urls, os.path.join(work_dir, "issues"))))
+
+    return results
+
+async def collect_issues_async(api_url, urls, output_root):
+    from issue_client import IssueClient
+    async with IssueClient(f"{api_url}/github/", f"{api_url}/jira", headers={}) as client:
+        await client.mine_all(urls, output_root)
+
+#RESULTS
+def compare(results, previous):
+    """
+    Print the change of every stage against an earlier run and return the
+    stages that got slower than REGRESSION_THRESHOLD allows
+    """
+    regressions = []
+    for stage, current in results["stages"].items():
+        if not isinstance(current, dict) or stage not in previous["stages"]:
+            continue
+        before = previous["stages"][stage]["seconds"]
+        ratio = current["seconds"] / before if before else 1.0
+        flag = ""
+        if ratio > REGRESSION_THRESHOLD:
+            regressions.append(stage)
+            flag = " REGRESSION"
+        print(f"{stage:>16}: {before:8.3f} s -> {current['seconds']:8.3f} s ({ratio:.2f}x){flag}")
+    return regressions
+
+def latest_result():
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    files = sorted(file for file in os.listdir(RESULTS_DIR) if file.endswith(".json"))
+    return os.path.join(RESULTS_DIR, files[-1]) if files else None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the mining stages on a synthetic repository")
+    parser.add_argument("--commits", type=int, default=500, help="number of commits (default: 500)")
+    parser.add_argument("--files", type=int, default=5, help="files changed per commit (default: 5)")
+    parser.add_argument("--diff-lines", type=int, default=20, help="lines changed per file (default: 20)")
+    parser.add_argument("--authors", type=int, default=10, help="number of authors (default: 10)")
+    parser.add_argument("--refactoring-ratio", type=float, default=0.5,
+        help="share of commits with refactorings in the RefactoringMiner fixture (default: 0.5)")
+    parser.add_argument("--issues", type=int, default=1000, help="issues served by the API stub (default: 1000)")
+    parser.add_argument("--issue-repos", type=int, default=8,
+        help="repositories whose issues the asynchronous client collects at once (default: 8)")
+    parser.add_argument("--api-delay", type=float, default=0.02, help="seconds the API stub waits per request (default: 0.02)")
+    parser.add_argument("--date-sample", type=int, default=200,
+        help="commits looked up one by one with get_commit_date (default: 200)")
+    parser.add_argument("--processes", type=int, default=4,
+        help="processes of the pooled diff extraction, 1 to skip it (default: 4)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the generated data (default: 0)")
+    parser.add_argument("--compare", nargs="?", const="latest",
+        help="compare with a results file, or the latest one if no file is given")
+    parser.add_argument("--keep", action="store_true", help="keep the generated repository and outputs")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    previous_path = latest_result() if args.compare == "latest" else args.compare
+
+    work_dir = tempfile.mkdtemp(prefix="miner-benchmark-")
+    try:
+        stages = run_benchmark(args, work_dir)
+    finally:
+        if args.keep:
+            print(f"Benchmark files kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        "date": datetime.now().isoformat(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("compare", "keep")},
+        "stages": stages
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    result_path = os.path.join(RESULTS_DIR, "{:%Y%m%d-%H%M%S}.json".format(datetime.now()))
+    with open(result_path, "w") as result_file:
+        json.dump(results, result_file, indent=2)
+    print(f"Results saved to {result_path}")
+
+    if previous_path:
+        with open(previous_path, "r") as previous_file:
+            previous = json.load(previous_file)
+        if previous["parameters"] != results["parameters"]:
+            print("Warning: the compared run used different parameters")
+        if compare(results, previous):
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
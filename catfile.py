@@ -0,0 +1,229 @@
+import subprocess
+import threading
+
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import metrics
+
+CACHE_SIZE = 4096 # Parsed commits and trees kept per reader
+TREE_MODE = "40000"
+SUBMODULE_MODE = "160000"
+
+class LruCache(object):
+    """
+    >>> cache = LruCache(2)
+    >>> cache.put("a", 1); cache.put("b", 2); cache.get("a")
+    1
+    >>> cache.put("c", 3) # Drops b, a was used more recently
+    >>> cache.get("b") is None, cache.get("a"), cache.get("c")
+    (True, 1, 3)
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+def parse_signature(line):
+    """
+    Name, email and date of an author or committer line
+
+    >>> parse_signature("Jane Doe <jane@example.org> 1700000000 +0200")
+    ('Jane Doe', 'jane@example.org', datetime.datetime(2023, 11, 15, 0, 13, 20, tzinfo=datetime.timezone(datetime.timedelta(seconds=7200))))
+    """
+    name_email, timestamp, offset = line.rsplit(" ", 2)
+    name, email = name_email.split(" <", 1)
+    sign = -1 if offset.startswith("-") else 1
+    zone = timezone(sign * timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5])))
+    return name, email.rstrip(">"), datetime.fromtimestamp(int(timestamp), zone)
+
+class CommitHeader(object):
+    """
+    The parsed header and message of a commit object
+    """
+    def __init__(self, hash, data):
+        self.hash = hash
+        self.tree = None
+        self.parents = []
+        header, _, message = data.decode("utf-8", "replace").partition("\n\n")
+        self.message = message
+        for line in header.splitlines():
+            key, _, value = line.partition(" ")
+            if key == "tree":
+                self.tree = value
+            elif key == "parent":
+                self.parents.append(value)
+            elif key == "author":
+                self.author_name, self.author_email, self.author_date = parse_signature(value)
+            elif key == "committer":
+                self.committer_name, self.committer_email, self.committer_date = parse_signature(value)
+
+def parse_tree(data):
+    """
+    Entries of a tree object as name -> (mode, object id)
+
+    >>> parse_tree(b"100644 a.py\\0" + bytes(range(20)) + b"40000 src\\0" + bytes(20))
+    {'a.py': ('100644', '000102030405060708090a0b0c0d0e0f10111213'), 'src': ('40000', '0000000000000000000000000000000000000000')}
+    """
+    entries = {}
+    position = 0
+    while position < len(data):
+        space = data.index(b" ", position)
+        end_of_name = data.index(b"\0", space)
+        mode = data[position:space].decode()
+        name = data[space + 1:end_of_name].decode("utf-8", "surrogateescape")
+        entries[name] = (mode, data[end_of_name + 1:end_of_name + 21].hex())
+        position = end_of_name + 21
+    return entries
+
+class CatFile(object):
+    """
+    Reads objects of a repository over two long-running git processes,
+    cat-file --batch for contents and --batch-check for types and sizes,
+    instead of starting git for every commit. Parsed commits and trees are
+    kept in an LRU cache, as the parent of one commit is usually the next
+    commit looked at.
+
+    A reader is used by one thread at a time and is not shared between
+    processes, every worker process opens its own.
+    """
+    def __init__(self, repo_path, cache_size=CACHE_SIZE):
+        self.repo_path = repo_path
+        self.lock = threading.Lock()
+        self.batch = None
+        self.batch_check = None
+        self.commits = LruCache(cache_size)
+        self.trees = LruCache(cache_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def start(self, mode):
+        metrics.count("subprocesses")
+        return subprocess.Popen(
+            ["git", "-C", self.repo_path, "cat-file", mode],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+
+    def request(self, process, name):
+        process.stdin.write(name.encode() + b"\n")
+        process.stdin.flush()
+        header = process.stdout.readline().decode().split()
+        if len(header) != 3: # "<name> missing" or "<name> ambiguous"
+            raise KeyError(f"{name} is not an object of {self.repo_path}")
+        return header
+
+    def info(self, name):
+        """
+        Object id, type and size of an object, any revision git understands
+        """
+        with self.lock:
+            if self.batch_check is None:
+                self.batch_check = self.start("--batch-check")
+            object_id, type, size = self.request(self.batch_check, name)
+        return object_id, type, int(size)
+
+    def read(self, name):
+        """
+        Object id, type and contents of an object
+        """
+        with self.lock:
+            if self.batch is None:
+                self.batch = self.start("--batch")
+            object_id, type, size = self.request(self.batch, name)
+            data = self.batch.stdout.read(int(size))
+            self.batch.stdout.read(1) # Newline after the contents
+        return object_id, type, data
+
+    def commit(self, commit_hash):
+        header = self.commits.get(commit_hash)
+        if header is None:
+            object_id, type, data = self.read(commit_hash)
+            if type != "commit":
+                raise KeyError(f"{commit_hash} is a {type}, not a commit")
+            header = CommitHeader(object_id, data)
+            self.commits.put(commit_hash, header)
+        return header
+
+    def tree(self, tree_id):
+        entries = self.trees.get(tree_id)
+        if entries is None:
+            entries = parse_tree(self.read(tree_id)[2])
+            self.trees.put(tree_id, entries)
+        return entries
+
+    def blob(self, blob_id):
+        return self.read(blob_id)[2]
+
+    def diff_trees(self, old_tree, new_tree, prefix=""):
+        """
+        Yield (path, old blob id, new blob id) for every file whose contents
+        differ between two trees, None where a side doesn't have the file.
+        Subtrees with the same id are skipped without reading them.
+        """
+        old_entries = self.tree(old_tree) if old_tree else {}
+        new_entries = self.tree(new_tree) if new_tree else {}
+        for name in sorted(old_entries.keys() | new_entries.keys()):
+            old_mode, old_id = old_entries.get(name, (None, None))
+            new_mode, new_id = new_entries.get(name, (None, None))
+            if old_id == new_id and old_mode == new_mode:
+                continue
+            path = prefix + name
+            old_blob = old_id if old_mode not in (None, TREE_MODE, SUBMODULE_MODE) else None
+            new_blob = new_id if new_mode not in (None, TREE_MODE, SUBMODULE_MODE) else None
+            if old_blob != new_blob:
+                yield path, old_blob, new_blob
+            if TREE_MODE in (old_mode, new_mode):
+                yield from self.diff_trees(
+                    old_id if old_mode == TREE_MODE else None,
+                    new_id if new_mode == TREE_MODE else None,
+                    path + "/"
+                )
+
+    def changed_files(self, commit_hash):
+        """
+        Files whose contents a commit changed compared to its parent, like
+        PyDriller's modified_files: every file of a root commit and none of
+        a merge. A file moved without changes has no contents of its own,
+        neither its old nor its new path is listed.
+        """
+        header = self.commit(commit_hash)
+        if len(header.parents) > 1:
+            return []
+        old_tree = self.commit(header.parents[0]).tree if header.parents else None
+        changes = list(self.diff_trees(old_tree, header.tree))
+        removed = {old_blob for _, old_blob, new_blob in changes if new_blob is None}
+        added = {new_blob for _, old_blob, new_blob in changes if old_blob is None}
+        moved = removed & added
+        return [
+            (path, old_blob, new_blob) for path, old_blob, new_blob in changes
+            if not (old_blob is None and new_blob in moved or new_blob is None and old_blob in moved)
+        ]
+
+    def close(self):
+        with self.lock:
+            for process in (self.batch, self.batch_check):
+                if process is not None:
+                    process.stdin.close()
+                    process.wait()
+                    process.stdout.close()
+            self.batch = self.batch_check = None
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,128 @@
+import os
+import statistics
+import subprocess
+
+import metrics
+
+from repository import CACHE_DIR, mirror_path, repository_name
+
+# Rough seconds of mining work, calibrated against past runs when there are any
+SECONDS_PER_COMMIT = 0.2
+SECONDS_PER_MEGABYTE = 1.0
+DEFAULT_SECONDS = 10 * 60 # A repository nothing is known about
+
+class OverBudget(Exception):
+    """
+    A stage of a repository ran past its time or memory budget. What it
+    finished is kept, the repository is deferred.
+    """
+    def __init__(self, stage, message):
+        super().__init__(message)
+        self.stage = stage
+
+def mirror_size(repo_name, cache_dir=CACHE_DIR):
+    """
+    Commit count and pack size in megabytes of a cached mirror, None if
+    there is no mirror yet
+    """
+    path = mirror_path(repo_name, cache_dir)
+    if not os.path.isdir(path):
+        return None
+    result = subprocess.run(
+        ["git", "-C", path, "rev-list", "--count", "--all"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
+    )
+    if result.returncode != 0:
+        return None
+    pack_dir = os.path.join(path, "objects", "pack")
+    pack_bytes = sum(
+        os.path.getsize(os.path.join(pack_dir, name)) for name in os.listdir(pack_dir) if name.endswith(".pack")
+    ) if os.path.isdir(pack_dir) else 0
+    return int(result.stdout), pack_bytes / 1024 ** 2
+
+def model_seconds(commits, pack_megabytes):
+    """
+    >>> model_seconds(1000, 50)
+    250.0
+    """
+    return commits * SECONDS_PER_COMMIT + pack_megabytes * SECONDS_PER_MEGABYTE
+
+def past_seconds(metrics_path=metrics.METRICS_FILE):
+    """
+    Longest recorded run of every repository. Later runs only mine new
+    commits, and a run that failed or ran out of budget counts as at least
+    as long as it took.
+    """
+    seconds = {}
+    if not os.path.exists(metrics_path):
+        return seconds
+    for record in metrics.read_metrics(metrics_path):
+        repo_name = record["repository"]
+        seconds[repo_name] = max(seconds.get(repo_name, 0.0), record["total_seconds"])
+    return seconds
+
+def estimate_costs(urls, cache_dir=CACHE_DIR, metrics_path=metrics.METRICS_FILE):
+    """
+    Estimated seconds of work of each URL, without cloning anything: the
+    past run time if the repository was mined before, otherwise the model
+    on the size of its cached mirror, scaled by how the model compared with
+    past runs. Repositories with neither get the median estimate.
+    """
+    history = past_seconds(metrics_path)
+    sizes = {url: mirror_size(repository_name(url), cache_dir) for url in urls}
+
+    ratios = [
+        history[repository_name(url)] / model_seconds(*size) for url, size in sizes.items()
+        if size and repository_name(url) in history and model_seconds(*size) > 0
+    ]
+    scale = statistics.median(ratios) if ratios else 1.0
+
+    costs = {}
+    for url, size in sizes.items():
+        if repository_name(url) in history:
+            costs[url] = history[repository_name(url)]
+        elif size:
+            costs[url] = model_seconds(*size) * scale
+    default = statistics.median(costs.values()) if costs else DEFAULT_SECONDS
+    return {url: costs.get(url, default) for url in urls}
+
+def longest_first(urls, costs):
+    """
+    The URLs ordered by estimated cost, longest first, so a huge repository
+    doesn't start last and keep one worker busy after the others are done
+
+    >>> longest_first(["a", "b", "c"], {"a": 1, "b": 5, "c": 1})
+    ['b', 'a', 'c']
+    """
+    return sorted(urls, key=lambda url: -costs[url])
+
+def makespan(costs, workers):
+    """
+    Seconds until every repository is mined when they are started longest
+    first on workers workers
+
+    >>> makespan([5, 4, 3, 3], 2)
+    8
+    """
+    finish_times = [0] * workers
+    for cost in sorted(costs, reverse=True):
+        earliest = finish_times.index(min(finish_times))
+        finish_times[earliest] += cost
+    return max(finish_times)
+
+def order_by_cost(urls, workers, cache_dir=CACHE_DIR, metrics_path=metrics.METRICS_FILE):
+    """
+    Order URLs longest first and print the expected makespan
+    """
+    costs = estimate_costs(urls, cache_dir, metrics_path)
+    ordered = longest_first(urls, costs)
+    if ordered:
+        print(
+            f"Estimated {sum(costs.values()) / 3600:.1f} hours of mining, {makespan(costs.values(), workers) / 3600:.1f} "
+            f"hours on {workers} workers, the longest is {repository_name(ordered[0])} ({costs[ordered[0]] / 3600:.1f} hours)\n"
+        )
+    return ordered
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
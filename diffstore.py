@@ -0,0 +1,113 @@
+import gzip
+import json
+import os
+
+from contextlib import contextmanager
+
+DIFFS_FILE = "diffs.jsonl.gz"
+INDEX_FILE = "diffs.index"
+
+class DiffStore(object):
+    """
+    Diffs of a repository, one JSON line per commit. Every line is compressed
+    as its own gzip member, so the whole file is still a normal .gz file that
+    can be streamed with gzip.open, while the index (hash, offset, length per
+    line) lets a reader decompress the diff of a single commit.
+
+    >>> import tempfile
+    >>> store = DiffStore(tempfile.mkdtemp())
+    >>> store.write({"commit_hash": "a", "diffs": []})
+    >>> store.write({"commit_hash": "b", "diffs": [{"file": "x.py"}]})
+    >>> store.read("b")
+    {'commit_hash': 'b', 'diffs': [{'file': 'x.py'}]}
+    >>> [record["commit_hash"] for record in store]
+    ['a', 'b']
+    >>> "a" in store, "c" in store
+    (True, False)
+
+    An index line cut short by an interrupted run is dropped with its record:
+    >>> with open(store.index_path, "a") as index_file: _ = index_file.write("c 12")
+    >>> len(DiffStore(os.path.dirname(store.index_path)))
+    2
+    """
+    def __init__(self, output_dir):
+        self.diffs_path = os.path.join(output_dir, DIFFS_FILE)
+        self.index_path = os.path.join(output_dir, INDEX_FILE)
+        self.index = {}
+        end = 0
+        if os.path.exists(self.index_path):
+            index_end = 0
+            with open(self.index_path, "rb") as index_file:
+                for line in index_file:
+                    fields = line.split()
+                    if not line.endswith(b"\n") or len(fields) != 3 or not fields[1].isdigit() or not fields[2].isdigit():
+                        break # Only the last line can be partial, the index is appended to
+                    commit_hash, offset, length = fields[0].decode(), int(fields[1]), int(fields[2])
+                    self.index[commit_hash] = (offset, length)
+                    end = max(end, offset + length)
+                    index_end += len(line)
+            if os.path.getsize(self.index_path) > index_end:
+                os.truncate(self.index_path, index_end)
+        # Drop a record that was written without its index line by an interrupted run
+        if os.path.exists(self.diffs_path) and os.path.getsize(self.diffs_path) > end:
+            os.truncate(self.diffs_path, end)
+
+    def __contains__(self, commit_hash):
+        return commit_hash in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        if not os.path.exists(self.diffs_path):
+            return
+        with gzip.open(self.diffs_path, "rt", encoding="utf-8") as diffs_file:
+            for line in diffs_file:
+                yield json.loads(line)
+
+    def write(self, record):
+        self.write_all([record])
+
+    def write_all(self, records):
+        with self.appender() as append:
+            for record in records:
+                append(record)
+
+    @contextmanager
+    def appender(self):
+        """
+        Yield a function that writes one record, the files are kept open
+        in between. The data is flushed before its index line, so the index
+        never points past the end of the data file.
+        """
+        with open(self.diffs_path, "ab") as diffs_file, open(self.index_path, "a") as index_file:
+            def append(record):
+                data = gzip.compress((json.dumps(record) + "\n").encode("utf-8"), mtime=0)
+                offset = diffs_file.tell()
+                diffs_file.write(data)
+                diffs_file.flush()
+                index_file.write(f"{record['commit_hash']} {offset} {len(data)}\n")
+                index_file.flush()
+                self.index[record["commit_hash"]] = (offset, len(data))
+            yield append
+
+    def read(self, commit_hash):
+        """
+        Diffs of a single commit, None if it isn't stored
+        """
+        if commit_hash not in self.index:
+            return None
+        offset, length = self.index[commit_hash]
+        with open(self.diffs_path, "rb") as diffs_file:
+            diffs_file.seek(offset)
+            return json.loads(gzip.decompress(diffs_file.read(length)))
+
+    def clear(self):
+        for path in (self.diffs_path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.index = {}
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,303 @@
+import csv
+import os
+import subprocess
+import argparse
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import jsonstream
+import metrics
+
+from datetime import datetime
+from diffstore import DiffStore
+
+TABLES_DIR = os.path.join(os.path.dirname(__file__), "output", "tables")
+BATCH_SIZE = 10_000
+GITHUB_ISSUES_SUFFIX = "_github_issues.json"
+JIRA_ISSUES_SUFFIX = "_jira_issues.json"
+
+SCHEMAS = {
+    "refactorings": pa.schema([
+        ("commit_hash", pa.string()),
+        ("type", pa.string()),
+        ("description", pa.string())
+    ]),
+    "commits": pa.schema([
+        ("commit_hash", pa.string()),
+        ("author", pa.string()),
+        ("committed_at", pa.timestamp("s", tz="UTC")),
+        ("refactorings", pa.int32()),
+        ("files_changed", pa.int32()),
+        ("lines_added", pa.int64()),
+        ("lines_deleted", pa.int64())
+    ]),
+    "effort": pa.schema([
+        ("developer", pa.string()),
+        ("refactoring_hash", pa.string()),
+        ("previous_hash", pa.string()),
+        ("tloc", pa.int64())
+    ]),
+    "issues": pa.schema([
+        ("source", pa.string()),
+        ("project", pa.string()),
+        ("key", pa.string()),
+        ("title", pa.string()),
+        ("issue_type", pa.string()),
+        ("status", pa.string()),
+        ("author", pa.string()),
+        ("created_at", pa.timestamp("s", tz="UTC")),
+        ("closed_at", pa.timestamp("s", tz="UTC")),
+        ("is_pull_request", pa.bool_())
+    ]),
+    "issue_links": pa.schema([
+        ("commit_hash", pa.string()),
+        ("source", pa.string()),
+        ("key", pa.string()),
+        ("issue_type", pa.string()),
+        ("status", pa.string())
+    ])
+}
+
+def parse_timestamp(value):
+    """
+    >>> parse_timestamp("2024-01-02T03:04:05Z")
+    datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    >>> parse_timestamp("2024-01-02T03:04:05.000+0200").isoformat()
+    '2024-01-02T03:04:05+02:00'
+    >>> parse_timestamp(None) is None
+    True
+    """
+    if not value:
+        return None
+    value = value.replace("Z", "+00:00")
+    if len(value) > 5 and value[-5] in "+-" and value[-3] != ":": # JIRA writes +0200
+        value = value[:-2] + ":" + value[-2:]
+    return datetime.fromisoformat(value).replace(microsecond=0)
+
+def partition_path(table, repo_name, tables_dir=TABLES_DIR):
+    """
+    Hive style partition, so pyarrow.dataset and DuckDB read the repository
+    column from the directory name
+    """
+    return os.path.join(tables_dir, table, f"repository={repo_name}", "part-0.parquet")
+
+def write_table(table, repo_name, rows, tables_dir=TABLES_DIR):
+    """
+    Replace a repository's partition of a table with rows, written in
+    batches so that a large repository never has to fit in memory.
+    Returns the number of rows.
+    """
+    schema = SCHEMAS[table]
+    path = partition_path(table, repo_name, tables_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    row_count = 0
+    with pq.ParquetWriter(path + ".tmp", schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                row_count += len(batch)
+                batch = []
+        if batch or row_count == 0: # An empty partition still tells the repository was exported
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+            row_count += len(batch)
+    os.replace(path + ".tmp", path) # Readers never see a half written partition
+    metrics.count("bytes_written", os.path.getsize(path))
+    return row_count
+
+def refactoring_rows(output_dir, refactoring_counts):
+    from main import RMINER_OUTPUT_FILE # main imports this module
+    rminer_path = os.path.join(output_dir, RMINER_OUTPUT_FILE)
+    if not os.path.exists(rminer_path):
+        return
+    with open(rminer_path, "r", encoding="utf-8") as rminer_file:
+        for commit in jsonstream.iter_array(rminer_file, "commits"):
+            refactoring_counts[commit["sha1"]] = len(commit["refactorings"])
+            for refactoring in commit["refactorings"]:
+                yield {
+                    "commit_hash": commit["sha1"],
+                    "type": refactoring["type"],
+                    "description": refactoring.get("description")
+                }
+
+def read_commit_log(repo_dir):
+    """
+    Author and commit date of every commit, streamed from a single git log
+    without holding the whole log in memory
+    """
+    metrics.count("subprocesses")
+    process = subprocess.Popen(
+        ["git", "-C", repo_dir, "log", "--all", "--format=%H%x00%an%x00%cI"],
+        stdout=subprocess.PIPE,
+        encoding="utf-8",
+        errors="replace"
+    )
+    for line in process.stdout:
+        commit_hash, author, date = line.rstrip("\n").split("\0")
+        yield commit_hash, author, parse_timestamp(date)
+    process.stdout.close()
+    if process.wait() != 0:
+        raise Exception(f"git log failed in {repo_dir}")
+
+def commit_rows(output_dir, refactoring_counts, repo_dir=None):
+    """
+    One row per commit with its refactoring count and diff size. Without
+    the repository only commits that have refactorings or diffs are known,
+    and their author and date are left empty.
+    """
+    diff_sizes = {}
+    for record in DiffStore(output_dir):
+        diff_sizes[record["commit_hash"]] = (
+            len(record["diffs"]),
+            sum(diff["added"] for diff in record["diffs"]),
+            sum(diff["deleted"] for diff in record["diffs"])
+        )
+
+    if repo_dir:
+        commits = read_commit_log(repo_dir)
+    else:
+        commits = ((commit_hash, None, None) for commit_hash in {**refactoring_counts, **diff_sizes})
+
+    for commit_hash, author, committed_at in commits:
+        files_changed, lines_added, lines_deleted = diff_sizes.get(commit_hash, (None, None, None))
+        yield {
+            "commit_hash": commit_hash,
+            "author": author,
+            "committed_at": committed_at,
+            "refactorings": refactoring_counts.get(commit_hash),
+            "files_changed": files_changed,
+            "lines_added": lines_added,
+            "lines_deleted": lines_deleted
+        }
+
+def effort_rows(output_dir):
+    from main import EFFORT_FILE_SUFFIX # main imports this module
+    for file_name in sorted(os.listdir(output_dir)):
+        if not file_name.endswith(EFFORT_FILE_SUFFIX):
+            continue
+        with open(os.path.join(output_dir, file_name), "r", newline="") as effort_file:
+            reader = csv.reader(effort_file)
+            next(reader, None) # Header
+            for refactoring_hash, previous_hash, tloc in reader:
+                yield {
+                    "developer": file_name[:-len(EFFORT_FILE_SUFFIX)],
+                    "refactoring_hash": refactoring_hash,
+                    "previous_hash": previous_hash,
+                    "tloc": int(tloc)
+                }
+
+def github_issue_row(project, issue):
+    return {
+        "source": "github",
+        "project": project,
+        "key": str(issue["number"]),
+        "title": issue.get("title"),
+        "issue_type": "pull_request" if "pull_request" in issue else "issue",
+        "status": issue.get("state"),
+        "author": (issue.get("user") or {}).get("login"),
+        "created_at": parse_timestamp(issue.get("created_at")),
+        "closed_at": parse_timestamp(issue.get("closed_at")),
+        "is_pull_request": "pull_request" in issue
+    }
+
+def jira_issue_row(project, issue):
+    fields = issue.get("fields") or {}
+    return {
+        "source": "jira",
+        "project": project,
+        "key": issue["key"],
+        "title": fields.get("summary"),
+        "issue_type": (fields.get("issuetype") or {}).get("name"),
+        "status": (fields.get("status") or {}).get("name"),
+        "author": (fields.get("reporter") or {}).get("displayName"),
+        "created_at": parse_timestamp(fields.get("created")),
+        "closed_at": parse_timestamp(fields.get("resolutiondate")),
+        "is_pull_request": False
+    }
+
+def issue_rows(output_dir):
+    for file_name in sorted(os.listdir(output_dir)):
+        if file_name.endswith(GITHUB_ISSUES_SUFFIX):
+            project, to_row = file_name[:-len(GITHUB_ISSUES_SUFFIX)], github_issue_row
+        elif file_name.endswith(JIRA_ISSUES_SUFFIX):
+            project, to_row = file_name[:-len(JIRA_ISSUES_SUFFIX)], jira_issue_row
+        else:
+            continue
+        with open(os.path.join(output_dir, file_name), "r", encoding="utf-8") as issue_file:
+            for issue in jsonstream.iter_array(issue_file):
+                yield to_row(project, issue)
+
+def issue_link_rows(output_dir):
+    from links import LINKS_FILE # links imports this module
+    path = os.path.join(output_dir, LINKS_FILE)
+    if not os.path.exists(path):
+        return
+    with open(path, "r", newline="") as links_file:
+        reader = csv.reader(links_file)
+        next(reader, None) # Header
+        for commit_hash, source, key, issue_type, status in reader:
+            yield {
+                "commit_hash": commit_hash,
+                "source": source,
+                "key": key,
+                "issue_type": issue_type or None,
+                "status": status or None
+            }
+
+def export_repository(repo_name, output_dir, repo_dir=None, tables_dir=TABLES_DIR):
+    """
+    Write everything mined for a repository into its partition of the
+    refactorings, commits, effort, issues and issue links tables. Returns the row count
+    of each table.
+    """
+    refactoring_counts = {}
+    return {
+        # The refactorings pass fills in refactoring_counts for the commits table
+        "refactorings": write_table("refactorings", repo_name, refactoring_rows(output_dir, refactoring_counts), tables_dir),
+        "commits": write_table("commits", repo_name, commit_rows(output_dir, refactoring_counts, repo_dir), tables_dir),
+        "effort": write_table("effort", repo_name, effort_rows(output_dir), tables_dir),
+        **export_issues(repo_name, output_dir, tables_dir)
+    }
+
+def export_issues(repo_name, output_dir, tables_dir=TABLES_DIR):
+    """
+    Write only the issues and issue links partitions of a repository, after
+    its issues were collected or linked again apart from mining. They don't
+    need the repository itself.
+    """
+    return {
+        "issues": write_table("issues", repo_name, issue_rows(output_dir), tables_dir),
+        "issue_links": write_table("issue_links", repo_name, issue_link_rows(output_dir), tables_dir)
+    }
+
+def read_table(table, columns=None, tables_dir=TABLES_DIR, **kwargs):
+    """
+    Read a table of every exported repository, only the columns asked for
+    are decoded
+    """
+    return pq.read_table(os.path.join(tables_dir, table), columns=columns, partitioning="hive", **kwargs)
+
+def main():
+    """
+    Export repositories that were mined before the export stage existed,
+    from what is in their output directories
+    """
+    from main import OUTPUT_ROOT
+    parser = argparse.ArgumentParser(description="Export mined outputs into Parquet tables")
+    parser.add_argument("repositories", nargs="*", help="repositories to export (default: all in output/)")
+    parser.add_argument("--tables-dir", default=TABLES_DIR)
+    args = parser.parse_args()
+
+    tables_dir = os.path.realpath(args.tables_dir)
+    repo_names = args.repositories or sorted(
+        name for name in os.listdir(OUTPUT_ROOT)
+        if os.path.isdir(os.path.join(OUTPUT_ROOT, name)) and os.path.join(OUTPUT_ROOT, name) != tables_dir
+    )
+    for repo_name in repo_names:
+        row_counts = export_repository(repo_name, os.path.join(OUTPUT_ROOT, repo_name), tables_dir=tables_dir)
+        print(f"{repo_name}: {row_counts}")
+
+if __name__ == "__main__":
+    main()
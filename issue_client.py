@@ -0,0 +1,202 @@
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+
+import export
+import issues
+import links
+import main
+import urlparser
+
+from repository import repository_name
+from state import StateStore
+
+CONCURRENT_REPOSITORIES = 16
+MAX_CONNECTIONS = 32
+REQUEST_TIMEOUT = 60
+
+class IssueClient(object):
+    """
+    Asynchronous GitHub and JIRA client that mines the issues of many
+    repositories at once over a pool of kept-alive connections. It writes
+    the same files as issues.collect_issue_data and shares its ETag cache,
+    JIRA page checkpoints and GitHub rate limit.
+
+    The API base URLs, the request headers and the JIRA project index can
+    be given, so the client can be pointed at a local mock.
+
+    Every repository fetches at most GITHUB_PAGE_WORKERS or JIRA_PAGE_WORKERS
+    pages at a time, and a request only times out once it has a connection,
+    so repositories with thousands of pages queue for the shared pool.
+    Files and the state store are written from worker threads, never on the
+    event loop.
+    """
+    def __init__(self, github_url=None, jira_url=None, headers=None, jira_index=None, max_connections=MAX_CONNECTIONS):
+        self.github_url = github_url or issues.GITHUB_API_URL
+        self.jira_url = jira_url or issues.APACHE_JIRA_API_URL
+        self.headers = headers
+        self.jira_index = jira_index
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, pool=None)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.client.aclose()
+
+    def github_headers(self):
+        return dict(issues.get_headers() if self.headers is None else self.headers)
+
+    async def wait_for_rate_limit(self):
+        delay = issues.rate_limit_reset - time.time()
+        if delay > 0:
+            print(f"{main.current_time()} - GitHub rate limit reached, waiting {int(delay)} seconds...")
+            await asyncio.sleep(delay)
+
+    async def github_get(self, url):
+        """
+        Like issues.github_get: the JSON body and Link header of a page,
+        waiting out the rate limit and revalidating cached pages by ETag
+        """
+        cached = await asyncio.to_thread(issues.read_etag_cache, url)
+
+        for _ in range(issues.GITHUB_MAX_RETRIES):
+            await self.wait_for_rate_limit()
+            response = await self.client.get(url, headers=issues.github_request_headers(self.github_headers(), cached))
+            if (page := await asyncio.to_thread(issues.github_page, url, response, cached)) is not None:
+                return page
+
+        raise issues.github_error(url, response)
+
+    async def check_github_issues(self, owner, repo):
+        await self.wait_for_rate_limit()
+        response = await self.client.get(f"{self.github_url}{owner}/{repo}", headers=self.github_headers())
+        issues.update_rate_limit(response)
+        return response.status_code == 200
+
+    async def fetch_github_issues(self, owner, repo):
+        issues_url = issues.github_issues_url(owner, repo, self.github_url)
+        repo_issues, links = await self.github_get(f"{issues_url}&page=1")
+        page = issues.last_page(links)
+
+        page_slots = asyncio.Semaphore(issues.GITHUB_PAGE_WORKERS)
+
+        async def fetch_page(page):
+            async with page_slots:
+                return await self.github_get(f"{issues_url}&page={page}")
+
+        pages = await asyncio.gather(*(fetch_page(page) for page in range(2, page + 1)))
+        for page_data, _ in pages:
+            repo_issues.extend(page_data)
+
+        while not issues.is_last_page(repo_issues, page):
+            page += 1
+            repo_issues.extend((await self.github_get(f"{issues_url}&page={page}"))[0])
+        return repo_issues
+
+    async def jira_search(self, project_key, start_at):
+        return issues.jira_page(await self.client.get(f"{self.jira_url}/search", params=issues.jira_search_params(project_key, start_at)))
+
+    async def fetch_jira_issues(self, project_key, output_path):
+        """
+        Like issues.fetch_jira_issues, with the same page checkpoints. At
+        most JIRA_PAGE_WORKERS pages of a project are requested at a time.
+        """
+        body = await self.jira_search(project_key, 0)
+        checkpoint_dir, missing_pages = await asyncio.to_thread(issues.start_jira_checkpoint, output_path, body)
+
+        page_slots = asyncio.Semaphore(issues.JIRA_PAGE_WORKERS)
+
+        async def fetch_page(start_at):
+            async with page_slots:
+                page = await self.jira_search(project_key, start_at)
+            await asyncio.to_thread(issues.save_jira_page, checkpoint_dir, start_at, page["issues"])
+
+        await asyncio.gather(*(fetch_page(start_at) for start_at in missing_pages))
+        return await asyncio.to_thread(issues.write_jira_issues, checkpoint_dir, body["total"], output_path)
+
+    async def collect_issue_data(self, url, output_dir):
+        owner, repo = issues.parse_github_repo(url)
+        if await self.check_github_issues(owner, repo):
+            repo_issues = await self.fetch_github_issues(owner, repo)
+            await asyncio.to_thread(issues.save_github_issues, output_dir, owner, repo, repo_issues)
+        elif project_key := issues.find_jira_project_key(repo, self.jira_index):
+            with issues.jira_project_claim(project_key) as claimed:
+                if not claimed:
+                    print(f"{main.current_time()} - JIRA issues already mined for: {url}")
+                    return
+                issue_count = await self.fetch_jira_issues(project_key, issues.jira_issues_path(output_dir, project_key))
+            print(f"{main.current_time()} - Retrieved {issue_count} issues for JIRA project {project_key}")
+        else:
+            print(f"{main.current_time()} - Issues are not enabled for {owner}/{repo}")
+
+    async def mine_all(self, urls, output_root, state=None, concurrency=CONCURRENT_REPOSITORIES):
+        """
+        Collect the issues of every repository, concurrency at a time, into
+        output_root/<repository>. With a state store repositories whose
+        issues are up to date with their remote HEAD are skipped, and the
+        issues stage is marked done for the others, so main.py leaves it out.
+        Returns the URLs that failed.
+        """
+        if self.jira_index is None:
+            self.jira_index = await asyncio.to_thread(issues.get_jira_index) # Once, before the repositories need it
+        repository_slots = asyncio.Semaphore(concurrency)
+        failed = []
+
+        async def mine(url):
+            async with repository_slots:
+                try:
+                    repo_name = repository_name(url)
+                    progress = None
+                    if state:
+                        head = await asyncio.to_thread(main.get_remote_head, url)
+                        if head is None:
+                            raise Exception("can't read the remote HEAD")
+                        progress = state.progress(repo_name, head)
+                        if await asyncio.to_thread(progress.is_done, "issues"):
+                            print(f"{main.current_time()} - Issues already up to date: {url}")
+                            return
+                    output_dir = os.path.join(output_root, repo_name)
+                    await asyncio.to_thread(os.makedirs, output_dir, exist_ok=True)
+                    await self.collect_issue_data(url, output_dir)
+                    # Repositories mined before their issues link again, and their tables are refreshed
+                    if await asyncio.to_thread(links.link_issues, output_dir) is not None:
+                        await asyncio.to_thread(export.export_issues, repo_name, output_dir)
+                    if progress:
+                        await asyncio.to_thread(progress.finish, "issues")
+                except Exception as e:
+                    print(f"{url}: {e}")
+                    failed.append(url)
+
+        await asyncio.gather(*(mine(url) for url in urls))
+        return failed
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Collect the issues of the Apache repositories, separately from mining them")
+    parser.add_argument("--projects", default=urlparser.SONAR_MEASURES_FILE,
+        help="CSV file with a project column listing the repositories (default: ./sonar_measures.csv)")
+    parser.add_argument("--url-shard", default=None, help="collect only shard i/n of the repositories")
+    parser.add_argument("-c", "--concurrency", type=int, default=CONCURRENT_REPOSITORIES,
+        help=f"repositories collected at the same time (default: {CONCURRENT_REPOSITORIES})")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+        help=f"size of the connection pool (default: {MAX_CONNECTIONS})")
+    parser.add_argument("--github-url", default=None, help="GitHub API base URL, for testing against a mock")
+    parser.add_argument("--jira-url", default=None, help="JIRA API base URL, for testing against a mock")
+    return parser.parse_args()
+
+async def run(args):
+    urls = urlparser.list_project_urls(args.projects, args.url_shard)
+    os.makedirs(main.OUTPUT_ROOT, exist_ok=True)
+    state = StateStore(os.path.join(main.OUTPUT_ROOT, main.STATE_FILE))
+    async with IssueClient(args.github_url, args.jira_url, max_connections=args.max_connections) as client:
+        failed = await client.mine_all(urls, main.OUTPUT_ROOT, state, args.concurrency)
+    print(f"{main.current_time()} - Done, {len(failed)} repositories failed")
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
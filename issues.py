@@ -1,103 +1,428 @@
 import os
 import requests
 import json
-from main import current_time
+import threading
+import time
+import hashlib
+import functools
+import shutil
+import contextlib
+import jsonstream
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from requests.adapters import HTTPAdapter
+import main # main imports this module, so its names are looked up when used
+from repository import CACHE_DIR, directory_size
 
 GITHUB_API_URL = "https://api.github.com/repos/"
 APACHE_JIRA_API_URL = "https://issues.apache.org/jira/rest/api/2"
+GITHUB_PAGE_SIZE = 100
+GITHUB_PAGE_WORKERS = 4
+GITHUB_MAX_RETRIES = 5
+ETAG_CACHE_DIR = os.path.join(CACHE_DIR, "github_etags")
+ETAG_CACHE_BUDGET = 1024 ** 3 # Bytes, least recently used pages are evicted past it
+JIRA_PROJECTS_CACHE_FILE = os.path.join(CACHE_DIR, "jira_projects.json")
+JIRA_PROJECTS_TTL = 7 * 24 * 60 * 60
+JIRA_PAGE_SIZE = 100
+JIRA_PAGE_WORKERS = 4
+REQUEST_TIMEOUT = 60
+# Only these fields are requested from JIRA, the rest of an issue is left out
+JIRA_FIELDS = [
+    "summary", "issuetype", "status", "priority", "resolution", "created", "updated",
+    "resolutiondate", "reporter", "assignee", "labels", "components", "versions", "fixVersions"
+]
+
+# Shared between all threads so connections are kept alive and reused
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_maxsize=16))
 
 def fetch_jira_projects():
     """
-    List of all apache software foundations jira spaces
+    List of all apache software foundations jira spaces, empty if JIRA
+    can't be reached
     """
-    response = requests.get(f"{APACHE_JIRA_API_URL}/project")
+    metrics.count("api_calls")
+    try:
+        response = session.get(f"{APACHE_JIRA_API_URL}/project", timeout = REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"{main.current_time()} - Failed to retrieve JIRA projects: {e}")
+        return []
 
     if response.status_code == 200:
         return response.json()
 
-    print(f"{current_time()} - Failed to retrieve JIRA projects: {response.status_code} - {response.text}")
+    print(f"{main.current_time()} - Failed to retrieve JIRA projects: {response.status_code} - {response.text}")
     return []
 
 def read_token():
     with open(".env", "r") as token_file:
         return token_file.read()
 
-token = read_token()
-headers = {
-    'Authorization': f'token {token.strip()}'
-}
-jira_projects = fetch_jira_projects()
-jira_projects = sorted(jira_projects, key=lambda project: len(project["key"]))
-jira_projects.reverse()
+# The token and the JIRA projects are only loaded when they are first needed,
+# importing this module doesn't read files or touch the network.
+@functools.cache
+def get_headers():
+    return {
+        'Authorization': f'token {read_token().strip()}'
+    }
+
+def load_jira_projects():
+    """
+    JIRA projects from the on-disk cache, fetched again when the cache is
+    older than JIRA_PROJECTS_TTL seconds. A stale cache is still used if
+    JIRA can't be reached.
+    """
+    cached_projects = None
+    if os.path.exists(JIRA_PROJECTS_CACHE_FILE):
+        with open(JIRA_PROJECTS_CACHE_FILE, "r") as cache_file:
+            cached_projects = json.load(cache_file)
+        if time.time() - os.path.getmtime(JIRA_PROJECTS_CACHE_FILE) < JIRA_PROJECTS_TTL:
+            return cached_projects
+
+    projects = fetch_jira_projects()
+    if not projects:
+        return cached_projects or []
+    os.makedirs(os.path.dirname(JIRA_PROJECTS_CACHE_FILE), exist_ok=True)
+    with open(JIRA_PROJECTS_CACHE_FILE, "w") as cache_file:
+        json.dump(projects, cache_file)
+    return projects
+
+@functools.cache
+def get_jira_index():
+    return JiraProjectIndex(load_jira_projects())
+
+class SubstringMatcher(object):
+    """
+    Aho-Corasick automaton, finds every word that occurs in a text in one
+    pass over the text, however many words there are.
+
+    >>> sorted(SubstringMatcher(["he", "she", "hers", "x"]).find_all("ushers"))
+    ['he', 'hers', 'she']
+    """
+    def __init__(self, words):
+        self.transitions = [{}]
+        self.failures = [0]
+        self.outputs = [[]]
+        for word in words:
+            state = 0
+            for char in word:
+                if char not in self.transitions[state]:
+                    self.transitions.append({})
+                    self.failures.append(0)
+                    self.outputs.append([])
+                    self.transitions[state][char] = len(self.transitions) - 1
+                state = self.transitions[state][char]
+            self.outputs[state].append(word)
+
+        # Breadth first, so the failure state of a parent is ready before its children
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for char, next_state in self.transitions[state].items():
+                failure = self.failures[state]
+                while failure and char not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                self.failures[next_state] = self.transitions[failure].get(char, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.failures[next_state]]
+                queue.append(next_state)
+
+    def find_all(self, text):
+        state = 0
+        for char in text:
+            while state and char not in self.transitions[state]:
+                state = self.failures[state]
+            state = self.transitions[state].get(char, 0)
+            yield from self.outputs[state]
+
+class JiraProjectIndex(object):
+    """
+    Lookup of JIRA project keys by lowercase key, for exact matches, and an
+    Aho-Corasick matcher for keys that occur inside a repository name
+    """
+    def __init__(self, projects):
+        self.keys = {}
+        for project in projects:
+            self.keys[project["key"].lower()] = project["key"]
+        self.matcher = SubstringMatcher(self.keys)
+
+    def exact(self, name):
+        return self.keys.get(name)
+
+    def longest_substring(self, name):
+        """
+        The longest key that occurs in name, longer keys are less likely to be false positives
+        """
+        matches = list(self.matcher.find_all(name))
+        return self.keys[max(matches, key=len)] if matches else None
+
+# GitHub rate limit shared by all threads, requests wait until this time (epoch seconds)
+rate_limit_reset = 0
+rate_limit_lock = threading.Lock()
+
+def wait_for_rate_limit():
+    with rate_limit_lock:
+        delay = rate_limit_reset - time.time()
+    if delay > 0:
+        print(f"{main.current_time()} - GitHub rate limit reached, waiting {int(delay)} seconds...")
+        time.sleep(delay)
+
+def update_rate_limit(response):
+    """
+    Read the rate limit headers of a response. Return True if the request was
+    rejected because of the rate limit and should be retried.
+    """
+    global rate_limit_reset
+    reset = None
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        reset = int(response.headers.get("X-RateLimit-Reset", time.time() + 60)) + 1
+    if response.status_code in (403, 429) and "Retry-After" in response.headers: # Secondary rate limit
+        reset = time.time() + int(response.headers["Retry-After"])
+    if reset is None:
+        return False
+    with rate_limit_lock:
+        rate_limit_reset = max(rate_limit_reset, reset)
+    return response.status_code in (403, 429)
+
+def etag_cache_path(url):
+    return os.path.join(ETAG_CACHE_DIR, hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+# Disk size of the ETag cache, measured when the first page is written and kept up to date after
+etag_cache_size = None
+etag_cache_lock = threading.Lock()
+
+def read_etag_cache(url):
+    cache_path = etag_cache_path(url)
+    try:
+        with open(cache_path, "r") as cache_file:
+            os.utime(cache_file.fileno()) # Mark as recently used for eviction
+            return json.load(cache_file)
+    except FileNotFoundError: # Never cached, or evicted meanwhile
+        return None
+
+def write_etag_cache(url, etag, body, links):
+    global etag_cache_size
+    os.makedirs(ETAG_CACHE_DIR, exist_ok=True)
+    cache_path = etag_cache_path(url)
+    data = json.dumps({"etag": etag, "body": body, "links": links})
+    with etag_cache_lock:
+        if etag_cache_size is None:
+            etag_cache_size = directory_size(ETAG_CACHE_DIR)
+        if os.path.exists(cache_path):
+            etag_cache_size -= os.path.getsize(cache_path)
+        with open(cache_path, "w") as cache_file:
+            cache_file.write(data)
+        etag_cache_size += os.path.getsize(cache_path)
+        if etag_cache_size > ETAG_CACHE_BUDGET:
+            evict_etag_cache()
+
+def evict_etag_cache():
+    """
+    Remove the least recently used pages until the cache is down to three
+    quarters of its budget, so the next eviction is some pages away
+    """
+    global etag_cache_size
+    paths = [os.path.join(ETAG_CACHE_DIR, name) for name in os.listdir(ETAG_CACHE_DIR)]
+    sizes = {path: os.path.getsize(path) for path in paths}
+    etag_cache_size = sum(sizes.values())
+    for path in sorted(paths, key=os.path.getmtime):
+        if etag_cache_size <= ETAG_CACHE_BUDGET * 3 // 4:
+            break
+        os.remove(path)
+        etag_cache_size -= sizes[path]
+
+def github_request_headers(headers, cached):
+    request_headers = dict(headers)
+    if cached:
+        request_headers["If-None-Match"] = cached["etag"]
+    return request_headers
+
+def github_page(url, response, cached):
+    """
+    JSON body and Link header of a GitHub response, from the ETag cache if
+    the page didn't change. None if the rate limit rejected the request and
+    it should be sent again. Works on requests and httpx responses alike.
+    """
+    if update_rate_limit(response):
+        return None
+    if response.status_code == 304:
+        return cached["body"], cached["links"]
+    if response.status_code == 200:
+        body = response.json()
+        if "ETag" in response.headers:
+            write_etag_cache(url, response.headers["ETag"], body, response.links)
+        return body, response.links
+    raise github_error(url, response)
+
+def github_error(url, response):
+    return Exception(f"Failed to fetch {url} from GitHub: {response.status_code} - {response.text}")
+
+def github_get(url):
+    """
+    GET a GitHub API URL and return the JSON body and the parsed Link header.
+    Waits out the rate limit instead of giving up. The ETag of every page is
+    cached on disk and sent back as If-None-Match, unchanged pages come back
+    as 304 which doesn't count against the rate limit.
+    """
+    cached = read_etag_cache(url)
+
+    for _ in range(GITHUB_MAX_RETRIES):
+        wait_for_rate_limit()
+        metrics.count("api_calls")
+        response = session.get(url, headers = github_request_headers(get_headers(), cached), timeout = REQUEST_TIMEOUT)
+        if (page := github_page(url, response, cached)) is not None:
+            return page
+
+    raise github_error(url, response)
+
+def page_number(url):
+    """
+    >>> page_number('https://api.github.com/repositories/1/issues?per_page=100&page=7')
+    7
+    """
+    return int(parse_qs(urlparse(url).query)["page"][0])
+
+def last_page(links):
+    return page_number(links["last"]["url"]) if "last" in links else 1
+
+def github_issues_url(owner, repo, api_url=None):
+    return f"{api_url or GITHUB_API_URL}{owner}/{repo}/issues?per_page={GITHUB_PAGE_SIZE}"
+
+def is_last_page(issues, page):
+    """
+    Whether the pages up to page hold all issues, issues opened while
+    fetching can push more pages past the last one
+    """
+    return len(issues) < page * GITHUB_PAGE_SIZE
 
 def check_github_issues(owner, repo):
-    response = requests.get(f"{GITHUB_API_URL}{owner}/{repo}", headers = headers)
+    wait_for_rate_limit()
+    metrics.count("api_calls")
+    response = session.get(f"{GITHUB_API_URL}{owner}/{repo}", headers = get_headers(), timeout = REQUEST_TIMEOUT)
+    update_rate_limit(response)
     return response.status_code == 200
 
 # Get issues from GitHub
 def fetch_github_issues(owner, repo):
     """
     Gets the github issues from repository.
+    The first page tells the number of pages in its Link header, the rest
+    are then fetched concurrently.
     >>> issues = fetch_github_issues('apache', 'incubator-iotdb')
     >>> len(issues) != 0
     True
     """
+    issues_url = github_issues_url(owner, repo)
+    issues, links = github_get(f"{issues_url}&page=1")
+    page = last_page(links)
 
-    issues = []
-    page = 1
-    while True:
-        response = requests.get(f"{GITHUB_API_URL}{owner}/{repo}/issues?page={page}", headers = headers)
-        if response.status_code != 200:
-            print(f"{current_time()} - Failed to fetch issues from GitHub: {response.status_code}")
-            break
-        page_data = response.json()
-        if not page_data:
-            break
-        issues.extend(page_data)
+    with ThreadPoolExecutor(max_workers=GITHUB_PAGE_WORKERS) as executor:
+        fetch_page = metrics.in_this_repository(lambda page: github_get(f"{issues_url}&page={page}")[0])
+        pages = executor.map(fetch_page, range(2, page + 1))
+        for page_data in pages:
+            issues.extend(page_data)
+
+    while not is_last_page(issues, page):
         page += 1
+        issues.extend(github_get(f"{issues_url}&page={page}")[0])
     return issues
 
 # Get the JIRA data
-def fetch_jira_issues(project_key):
+def jira_search_params(project_key, start_at):
     """
-    Gets the jira issues from repository.
-    >>> issues = fetch_jira_data('GEOMETRY')
-    >>> len(issues) != 0
-    True
+    One page of issues of a JIRA project, in a fixed order so that pages
+    can be fetched in any order without issues moving between them
     """
-    issues = []
+    return {
+        "jql": f"project={project_key} ORDER BY key ASC",
+        "startAt": start_at,
+        "maxResults": JIRA_PAGE_SIZE,
+        "fields": ",".join(JIRA_FIELDS)
+    }
+
+def jira_page(response):
+    if response.status_code != 200:
+        raise Exception(f"Failed to retrieve JIRA data: {response.status_code} - {response.text}")
+    return response.json()
+
+def jira_search(project_key, start_at):
+    metrics.count("api_calls")
+    return jira_page(session.get(f"{APACHE_JIRA_API_URL}/search", params = jira_search_params(project_key, start_at), timeout = REQUEST_TIMEOUT))
 
-    response = requests.get(f"{APACHE_JIRA_API_URL}/search?jql=project={project_key}&maxResults=100")
-    body = response.json()
+def save_jira_page(checkpoint_dir, start_at, issues):
+    page_path = os.path.join(checkpoint_dir, f"{start_at}.json")
+    with open(page_path + ".tmp", "w") as page_file:
+        json.dump(issues, page_file)
+    os.replace(page_path + ".tmp", page_path) # A page file is either complete or missing
+
+def fetch_jira_issues(project_key, output_path, workers=JIRA_PAGE_WORKERS):
+    """
+    Gets the jira issues from repository and writes them to output_path.
+    Pages are stored in a checkpoint directory as they arrive, so an
+    interrupted fetch continues from the pages it is missing. Returns the
+    number of issues.
+    >>> import tempfile
+    >>> fetch_jira_issues('GEOMETRY', os.path.join(tempfile.mkdtemp(), 'GEOMETRY_jira_issues.json')) != 0
+    True
+    """
+    # The first page is always fetched again, it tells the current total
+    body = jira_search(project_key, 0)
     total = body["total"]
+    checkpoint_dir, missing_pages = start_jira_checkpoint(output_path, body)
 
-    issues.extend(body["issues"])
+    def fetch_page(start_at):
+        print(f"Querying for issues {start_at}-{start_at + JIRA_PAGE_SIZE} out of {total}")
+        save_jira_page(checkpoint_dir, start_at, jira_search(project_key, start_at)["issues"])
 
-    issues_start_index = 100
-    while issues_start_index < total:
-        print(f"Querying for issues {issues_start_index}-{issues_start_index + 100} out of {total}")
-        response = requests.get(f"{APACHE_JIRA_API_URL}/search?jql=project={project_key}&startAt={issues_start_index}&maxResults=100")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(metrics.in_this_repository(fetch_page), missing_pages): # Raises the first failure
+            pass
 
-        if response.status_code != 200:
-            print(f"{current_time()} - Failed to retrieve JIRA data: {response.status_code} - {response.text}")
+    return write_jira_issues(checkpoint_dir, total, output_path)
 
-        body = response.json()
+def start_jira_checkpoint(output_path, first_page):
+    """
+    Checkpoint directory of output_path with the first page saved in it,
+    and the pages that are still missing from an earlier fetch
+    """
+    checkpoint_dir = output_path + ".pages"
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    save_jira_page(checkpoint_dir, 0, first_page["issues"])
+    return checkpoint_dir, missing_jira_pages(checkpoint_dir, first_page["total"])
 
-        issues.extend(body["issues"])
+def missing_jira_pages(checkpoint_dir, total):
+    return [
+        start_at for start_at in range(JIRA_PAGE_SIZE, total, JIRA_PAGE_SIZE)
+        if not os.path.exists(os.path.join(checkpoint_dir, f"{start_at}.json"))
+    ]
 
-        issues_start_index += 100
+def write_jira_issues(checkpoint_dir, total, output_path):
+    """
+    Join the checkpointed pages into output_path and remove them, returns
+    the number of issues
+    """
+    def all_issues():
+        for start_at in range(0, max(total, 1), JIRA_PAGE_SIZE):
+            with open(os.path.join(checkpoint_dir, f"{start_at}.json"), "r") as page_file:
+                yield from json.load(page_file)
 
-    return issues
+    with open(output_path + ".tmp", "w") as issue_file:
+        issue_count = jsonstream.write_array(issue_file, all_issues())
+    os.replace(output_path + ".tmp", output_path)
+    shutil.rmtree(checkpoint_dir)
+    return issue_count
 
 # Find JIRA project key
-def find_jira_project_key(repo, jira_projects):
+def find_jira_project_key(repo, index=None):
     """
     Get key for jira project.
-    >>> find_jira_project_key('iotdb', fetch_jira_data())
+    >>> index = JiraProjectIndex([{"key": "IO"}, {"key": "IOTDB"}, {"key": "SLING"}, {"key": "ABC"}])
+    >>> find_jira_project_key('iotdb', index)
     'IOTDB'
-    >>> find_jira_project_key('abcdef', fetch_jira_data()) is None
+    >>> find_jira_project_key('incubator-iotdb-client', index)
+    'IOTDB'
+    >>> find_jira_project_key('xyz', index) is None
     True
-    >>> find_jira_project_key('sling-org-apache-sling-scripting-thymeleaf', fetch_jira_data())
+    >>> find_jira_project_key('sling-org-apache-sling-scripting-thymeleaf', index)
     'SLING'
     """
     if repo.startswith("sling"):
@@ -107,16 +432,9 @@ def find_jira_project_key(repo, jira_projects):
         # Remove 'incubator' from start to avoid false positives
         repo = repo[len("incubator-"):]
 
-    # First search for exact matches
-    for project in jira_projects:
-        if project['key'].lower() == repo.lower():
-            return project['key']
-
-    # Then if there's no exact matches, we search for the key in the repo name
-    for project in jira_projects:
-        if project['key'].lower() in repo.lower():
-            return project['key']
-    return None
+    index = index or get_jira_index()
+    # First search for exact matches, then for the key in the repo name
+    return index.exact(repo.lower()) or index.longest_substring(repo.lower())
 
 def parse_github_repo(url):
     parts = url.split('/')
@@ -125,29 +443,64 @@ def parse_github_repo(url):
 # We store project keys that have already been crawled through to avoid going
 # through the same issues multiple times. This applies to projects like SLING,
 # which has multiple repos but a single issue tracker.
+# Repositories are mined in parallel, so the list is guarded with a lock.
 already_fetched = []
+already_fetched_lock = threading.Lock()
+
+def claim_jira_project(project_key):
+    """
+    Mark a JIRA project as fetched, return False if someone already did
+    """
+    with already_fetched_lock:
+        if project_key in already_fetched:
+            return False
+        already_fetched.append(project_key)
+        return True
+
+@contextlib.contextmanager
+def jira_project_claim(project_key):
+    """
+    Claim a JIRA project while its issues are fetched, gives False if
+    another repository already did. A failed fetch gives the claim back so
+    another repository retries it.
+    """
+    if not claim_jira_project(project_key):
+        yield False
+        return
+    try:
+        yield True
+    except BaseException:
+        with already_fetched_lock:
+            already_fetched.remove(project_key)
+        raise
+
+def jira_issues_path(output_dir, project_key):
+    return os.path.join(output_dir, f"{project_key}_jira_issues.json")
+
+def save_github_issues(output_dir, owner, repo, issues):
+    print(f"{main.current_time()} - Retrieved {len(issues)} issues for GitHub repo {owner}/{repo}")
+    with open(os.path.join(output_dir, f"{repo}_github_issues.json"), "w") as issue_file:
+        json.dump(issues, issue_file)
 
 def mine_issue_data(url, output_dir):
+    with metrics.stage("issues"):
+        collect_issue_data(url, output_dir)
+
+def collect_issue_data(url, output_dir):
     # GitHub repository processing
     owner, repo = parse_github_repo(url)
     if check_github_issues(owner, repo):
-        issues = fetch_github_issues(owner, repo)
-        print(f"{current_time()} - Retrieved {len(issues)} issues for GitHub repo {owner}/{repo}")
-        with open(os.path.join(output_dir, f"{repo}_github_issues.json"), "w") as issue_file:
-            json.dump(issues, issue_file)
-    elif find_jira_project_key(repo, jira_projects):
+        save_github_issues(output_dir, owner, repo, fetch_github_issues(owner, repo))
+    elif project_key := find_jira_project_key(repo):
         # JIRA project processing
-        project_key = find_jira_project_key(repo, jira_projects)
-        if project_key and project_key not in already_fetched:
-            issues = fetch_jira_issues(project_key)
-            print(f"{current_time()} - Retrieved {len(issues)} issues for JIRA project {project_key}")
-            with open(os.path.join(output_dir, f"{project_key}_jira_issues.json"), "w") as issue_file:
-                json.dump(issues, issue_file)
-            already_fetched.append(project_key)
-        else:
-            print(f"{current_time()} - JIRA issues already mined for: {url}")
+        with jira_project_claim(project_key) as claimed:
+            if not claimed:
+                print(f"{main.current_time()} - JIRA issues already mined for: {url}")
+                return
+            issue_count = fetch_jira_issues(project_key, jira_issues_path(output_dir, project_key))
+        print(f"{main.current_time()} - Retrieved {issue_count} issues for JIRA project {project_key}")
     else:
-        print(f"{current_time()} - Issues are not enabled for {owner}/{repo}")
+        print(f"{main.current_time()} - Issues are not enabled for {owner}/{repo}")
 
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,138 @@
+import json
+
+CHUNK_SIZE = 1 << 16
+WHITESPACE = " \t\n\r"
+
+_decoder = json.JSONDecoder()
+
+class _Buffer(object):
+    """
+    Text read from a stream that is only partially kept in memory.
+    Consumed text is dropped as the position moves forward.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self, size=CHUNK_SIZE):
+        """
+        Read at least size more characters, fewer only at the end of the stream
+        """
+        if self.pos > CHUNK_SIZE:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        chunk = self.stream.read(max(size, CHUNK_SIZE))
+        if not chunk:
+            self.eof = True
+        self.text += chunk
+        return bool(chunk)
+
+    def next_char(self):
+        """
+        Skip whitespace and return the next character without consuming it
+        """
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.read_more():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def expect(self, char):
+        if self.next_char() != char:
+            raise ValueError(f"Expected '{char}' at JSON stream position {self.pos}")
+        self.pos += 1
+
+    def decode_value(self):
+        """
+        Decode the next complete JSON value, reading more text until it fits.
+        Every failed attempt parses the value from its start again, so the
+        pending text is doubled before the next one, which keeps decoding a
+        large value linear in its size.
+        """
+        self.next_char()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                # A number at the very end of the buffer may continue in the next chunk
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read_more(len(self.text) - self.pos)
+
+def iter_array(stream, key=None):
+    """
+    Yield the items of a JSON array one at a time from a text stream, so that
+    only one item is kept in memory. If key is given the array is looked up from
+    the top level object, otherwise the stream itself must be an array.
+
+    >>> import io
+    >>> list(iter_array(io.StringIO('{"a": 1, "commits": [{"sha1": "x"}, {"sha1": "y"}]}'), "commits"))
+    [{'sha1': 'x'}, {'sha1': 'y'}]
+    >>> list(iter_array(io.StringIO(' [1, 22 , []] ')))
+    [1, 22, []]
+    >>> list(iter_array(io.StringIO('{"other": []}'), "commits"))
+    []
+    """
+    buffer = _Buffer(stream)
+    if key is not None and not _find_key(buffer, key):
+        return
+
+    buffer.expect("[")
+    if buffer.next_char() == "]":
+        return
+    while True:
+        yield buffer.decode_value()
+        if buffer.next_char() == "]":
+            return
+        buffer.expect(",")
+
+def write_array(file, items):
+    """
+    Write items to a text file as a JSON array without building it in memory.
+    Returns the number of items written.
+
+    >>> import io
+    >>> out = io.StringIO()
+    >>> write_array(out, iter([{"a": 1}, 2]))
+    2
+    >>> out.getvalue()
+    '[{"a": 1},2]'
+    """
+    count = 0
+    file.write("[")
+    for item in items:
+        if count > 0:
+            file.write(",")
+        json.dump(item, file)
+        count += 1
+    file.write("]")
+    return count
+
+def _find_key(buffer, key):
+    """
+    Move the buffer to the value of key in the top level object.
+    Values of other keys are decoded and thrown away.
+    """
+    buffer.expect("{")
+    if buffer.next_char() == "}":
+        return False
+    while True:
+        current_key = buffer.decode_value()
+        buffer.expect(":")
+        if current_key == key:
+            return True
+        buffer.decode_value()
+        if buffer.next_char() == "}":
+            return False
+        buffer.expect(",")
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
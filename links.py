@@ -0,0 +1,184 @@
+import argparse
+import csv
+import glob
+import os
+import re
+import subprocess
+
+import jsonstream
+import metrics
+
+from export import GITHUB_ISSUES_SUFFIX, JIRA_ISSUES_SUFFIX, export_issues, github_issue_row, jira_issue_row
+
+REFERENCES_FILE = "issue_references.csv"
+LINKS_FILE = "issue_links.csv"
+JIRA_KEY = re.compile(r"\b([A-Z][A-Z0-9_]+)-([1-9][0-9]*)\b")
+GITHUB_NUMBER = re.compile(r"(?<![\w&/])#([1-9][0-9]*)\b") # Not an anchor in a URL or an HTML entity
+READ_SIZE = 1 << 16
+
+def extract_references(message):
+    """
+    The (source, key) pairs of the issues a commit message mentions
+
+    >>> sorted(extract_references("LANG-1234: Fix #56 (see also LANG-99, &#39;)"))
+    [('github', '56'), ('jira', 'LANG-1234'), ('jira', 'LANG-99')]
+    >>> extract_references("https://example.org/page#3")
+    set()
+    """
+    references = {("jira", match.group(0)) for match in JIRA_KEY.finditer(message)}
+    references.update(("github", match.group(1)) for match in GITHUB_NUMBER.finditer(message))
+    return references
+
+def read_commit_messages(repo_dir):
+    """
+    Yield (hash, message) of every commit from a single git log stream,
+    without holding the whole log in memory
+    """
+    metrics.count("subprocesses")
+    process = subprocess.Popen(
+        ["git", "-C", repo_dir, "log", "--all", "-z", "--format=%H%n%B"],
+        stdout=subprocess.PIPE,
+        encoding="utf-8",
+        errors="replace"
+    )
+    rest = ""
+    while chunk := process.stdout.read(READ_SIZE):
+        *records, rest = (rest + chunk).split("\0")
+        for record in records:
+            commit_hash, _, message = record.partition("\n")
+            yield commit_hash, message
+    if rest:
+        commit_hash, _, message = rest.partition("\n")
+        yield commit_hash, message
+    process.stdout.close()
+    process.wait()
+
+def index_references(repo_dir, hashes):
+    """
+    Inverted index (source, key) -> commit hashes of the issues mentioned
+    by the given commits, built in one pass over the history
+    """
+    hashes = set(hashes)
+    index = {}
+    for commit_hash, message in read_commit_messages(repo_dir):
+        if commit_hash in hashes:
+            for reference in extract_references(message):
+                index.setdefault(reference, []).append(commit_hash)
+    return index
+
+def write_references(output_dir, index):
+    with open(os.path.join(output_dir, REFERENCES_FILE), "w", newline="") as references_file:
+        writer = csv.writer(references_file)
+        writer.writerow(["commit hash", "source", "issue"])
+        for (source, key), commit_hashes in index.items():
+            writer.writerows([commit_hash, source, key] for commit_hash in commit_hashes)
+
+def read_references(output_dir):
+    """
+    The index written by write_references, None if there is none
+    """
+    path = os.path.join(output_dir, REFERENCES_FILE)
+    if not os.path.exists(path):
+        return None
+    index = {}
+    with open(path, "r", newline="") as references_file:
+        reader = csv.reader(references_file)
+        next(reader, None) # Header
+        for commit_hash, source, key in reader:
+            index.setdefault((source, key), []).append(commit_hash)
+    return index
+
+def issue_files(output_dir, jira_projects):
+    """
+    Issue files of the repository, and for JIRA projects it mentions but
+    doesn't have the file of, the file another repository of the same
+    project collected
+    """
+    files = []
+    local_projects = set()
+    for file_name in sorted(os.listdir(output_dir)):
+        if file_name.endswith(GITHUB_ISSUES_SUFFIX):
+            files.append(("github", os.path.join(output_dir, file_name)))
+        elif file_name.endswith(JIRA_ISSUES_SUFFIX):
+            files.append(("jira", os.path.join(output_dir, file_name)))
+            local_projects.add(file_name[:-len(JIRA_ISSUES_SUFFIX)])
+
+    output_root = os.path.dirname(os.path.normpath(output_dir))
+    for project in sorted(jira_projects - local_projects):
+        for path in glob.glob(os.path.join(glob.escape(output_root), "*", project + JIRA_ISSUES_SUFFIX))[:1]:
+            files.append(("jira", path))
+    return files
+
+def read_issues(source, path):
+    """
+    Yield (key, type, status) of every issue in an issue file, one issue
+    in memory at a time
+    """
+    to_row = github_issue_row if source == "github" else jira_issue_row
+    with open(path, "r", encoding="utf-8") as issue_file:
+        for issue in jsonstream.iter_array(issue_file):
+            row = to_row(None, issue)
+            yield row["key"], row["issue_type"], row["status"]
+
+def link_issues(output_dir):
+    """
+    Join the commit references of a repository with its mined issues into
+    issue_links.csv, one row per commit and issue it mentions. Every issue
+    is looked up in the index once, so the join is linear in the number of
+    issues and references. Returns the number of links, None if the
+    references weren't indexed yet.
+    """
+    index = read_references(output_dir)
+    if index is None:
+        return None
+    jira_projects = {key.rsplit("-", 1)[0] for source, key in index if source == "jira"}
+
+    link_count = 0
+    with open(os.path.join(output_dir, LINKS_FILE + ".tmp"), "w", newline="") as links_file:
+        writer = csv.writer(links_file)
+        writer.writerow(["commit hash", "source", "issue", "issue type", "status"])
+        for source, path in issue_files(output_dir, jira_projects):
+            for key, issue_type, status in read_issues(source, path):
+                for commit_hash in index.get((source, key), ()):
+                    writer.writerow([commit_hash, source, key, issue_type, status])
+                    link_count += 1
+    os.replace(os.path.join(output_dir, LINKS_FILE + ".tmp"), os.path.join(output_dir, LINKS_FILE))
+    return link_count
+
+def refactoring_commit_hashes(output_dir):
+    from main import RMINER_OUTPUT_FILE # main imports this module
+    with open(os.path.join(output_dir, RMINER_OUTPUT_FILE), "r", encoding="utf-8") as rminer_file:
+        for commit in jsonstream.iter_array(rminer_file, "commits"):
+            if commit["refactorings"]:
+                yield commit["sha1"]
+
+def link_repository(repo_dir, output_dir):
+    """
+    Index the issues the refactoring commits mention and link them with the
+    mined issues
+    """
+    write_references(output_dir, index_references(repo_dir, refactoring_commit_hashes(output_dir)))
+    return link_issues(output_dir)
+
+def main():
+    """
+    Link again after issues were collected apart from mining, the commit
+    references were indexed when the repository was mined
+    """
+    from main import OUTPUT_ROOT
+    parser = argparse.ArgumentParser(description="Link refactoring commits with the issues they mention")
+    parser.add_argument("repositories", nargs="*", help="repositories to link (default: all in output/)")
+    args = parser.parse_args()
+
+    repo_names = args.repositories or sorted(
+        name for name in os.listdir(OUTPUT_ROOT) if os.path.exists(os.path.join(OUTPUT_ROOT, name, REFERENCES_FILE))
+    )
+    for repo_name in repo_names:
+        output_dir = os.path.join(OUTPUT_ROOT, repo_name)
+        link_count = link_issues(output_dir)
+        if link_count is not None:
+            export_issues(repo_name, output_dir)
+        print(f"{repo_name}: {link_count} links")
+
+if __name__ == "__main__":
+    main()
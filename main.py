@@ -1,197 +1,711 @@
 import subprocess
 import os
 import urlparser
-import docker
-import tarfile
 import json
 import csv
 import issues
-import sys
+import argparse
+import jsonstream
+import metrics
+import export
+import socket
+import lizard
+import lizard_languages
+import workqueue
+import links
+import heapq
 
 from datetime import datetime, timedelta
-from repository import Repository
-from pydriller import Repository as PyDriller
-from pydriller import Git, Commit
-
-TAR_FILE = "./temp.tar"
-MINER_OUTPUT_FILE = "output.json"
+from concurrent.futures import ThreadPoolExecutor
+from repository import Repository, repository_name, remove_tree, is_partial, fetch_missing_objects, CACHE_DIR
+from git import NULL_TREE, Repo
+from pydriller import Commit
+from pydriller.domain.commit import ModifiedFile
+from scheduler import StageLimits, NO_LIMITS, run_parallel
+from state import StateStore, RepositoryProgress
+from nloc_cache import NlocCache, blob_id, get_shared_cache
+from diffstore import DiffStore
+from minerpool import MinerPool
+from visitor import Collector, traverse
+from timeline import TimelineBuilder, TIMELINE_FILE
+from cost import OverBudget, order_by_cost
+from catfile import CatFile
+
+OUTPUT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output")
+RMINER_OUTPUT_FILE = "rminer-output.json"
+RMINER_NEW_OUTPUT_FILE = "rminer-new.json"
+EFFORT_FILE_SUFFIX = "_developer_effort.csv"
+STATE_FILE = "state.db"
 TIOBE_LANGUAGES = [
     "Python", "Java", "C", "C++", "C#", "JavaScript", "PHP", "Ruby", "Go",
     "TypeScript", "Swift", "Kotlin", "Rust", "Scala", "Dart", "R", "Objective-C"
 ]
 
+LANGUAGE_MAP = {
+    ".py": "Python", ".java": "Java", ".c": "C", ".cpp": "C++", ".cs": "C#",
+    ".js": "JavaScript", ".php": "PHP", ".rb": "Ruby", ".go": "Go",
+    ".ts": "TypeScript", ".swift": "Swift", ".kt": "Kotlin", ".rs": "Rust",
+    ".scala": "Scala", ".dart": "Dart", ".r": "R", ".m": "Objective-C"
+}
+
 def current_time(): return "{:%H:%M:%S}".format(datetime.now().time())
 
 #CHECK PROGRAMMING LANGUAGE
+def get_language(extension: str) -> str:
+    """
+    TIOBE language of a file extension, None if it isn't one
+    """
+    language = LANGUAGE_MAP.get(extension)
+    return language if language in TIOBE_LANGUAGES else None
+
 def is_programing_language(extension: str) -> bool:
-    language_map = {
-        ".py": "Python", ".java": "Java", ".c": "C", ".cpp": "C++", ".cs": "C#",
-        ".js": "JavaScript", ".php": "PHP", ".rb": "Ruby", ".go": "Go",
-        ".ts": "TypeScript", ".swift": "Swift", ".kt": "Kotlin", ".rs": "Rust",
-        ".scala": "Scala", ".dart": "Dart", ".r": "R", ".m": "Objective-C"
-    }
-    return language_map.get(extension) in TIOBE_LANGUAGES
+    return get_language(extension) is not None
 
 #GET LINES OF CODE
-def get_loc(commit: Commit) -> int:
+def get_file_nloc(file, language: str, nloc_cache: NlocCache) -> int:
+    """
+    Lines of code of a modified file after the commit, looked up by blob id
+    from the cache before asking lizard through pydriller
+    """
+    content = file.content
+    if content is None: # Deleted file
+        return 0
+    file_blob_id = blob_id(content)
+    cached = nloc_cache.get(file_blob_id)
+    if cached and cached[1] == language:
+        return cached[0]
+    nloc = file.nloc if file.nloc is not None else 0
+    nloc_cache.put(file_blob_id, nloc, language)
+    return nloc
+
+def get_blob_nloc(path: str, blob: str, language: str, nloc_cache: NlocCache, cat_file: CatFile) -> int:
+    """
+    Lines of code of a blob read through cat_file. The blob id comes from
+    the tree, so a cached blob isn't read at all.
+    """
+    if blob is None: # Deleted file
+        return 0
+    cached = nloc_cache.get(blob)
+    if cached and cached[1] == language:
+        return cached[0]
+    content = cat_file.blob(blob)
+    nloc = 0
+    # The same analysis pydriller's ModifiedFile.nloc runs
+    if content and lizard_languages.get_reader_for(path) is not None:
+        nloc = lizard.analyze_file.analyze_source_code(path, content.decode("utf-8", "ignore")).nloc
+    nloc_cache.put(blob, nloc, language)
+    return nloc
+
+def get_loc(commit: Commit, nloc_cache: NlocCache = None, cat_file: CatFile = None) -> int:
+    """
+    Lines of code of the files a commit changed. With cat_file the changed
+    files are found by comparing trees and read over its pipes instead of
+    asking pydriller for the commit's diff.
+    """
+    nloc_cache = nloc_cache or get_shared_cache()
     loc = 0
+    if cat_file is not None:
+        for path, _, blob in cat_file.changed_files(commit.hash):
+            language = get_language(os.path.splitext(path)[1])
+            if language is not None:
+                loc += get_blob_nloc(path, blob, language, nloc_cache, cat_file)
+        return loc
+
     for file in commit.modified_files:
         _, ext = os.path.splitext(file.filename)
-        if not is_programing_language(ext):
+        language = get_language(ext)
+        if language is None:
             continue
-        loc += file.nloc if file.nloc is not None else 0
+        loc += get_file_nloc(file, language, nloc_cache)
     return loc
 
 #GET HASHES
 def get_hashes(repo_path: str):
     command = ["git", "-C", repo_path, "rev-list", "--all"]
+    metrics.count("subprocesses")
     result = subprocess.run(command, stdout = subprocess.PIPE, text = True)
     return result.stdout.splitlines()
 
 #ANALYSE THE REPOSITORY
-def collect_developer_effort(repo_path: str, output_dir: str, refactoring_hashes: list[str]):
-    refactoring_hashes = list(set(refactoring_hashes))  # Remove duplicates
-
-    gr = Git(repo_path)
-    processed_hashes = set()
-
-    for commit_hash in refactoring_hashes:
-            commit = gr.get_commit(commit_hash)
-            developer_name = commit.author.name.replace(" ", "_") if commit.author else "Unknown"
-
-            developer_file_name = f"{developer_name}_developer_effort.csv"
-            output_file_path = os.path.join(output_dir, developer_file_name)
-
+def get_first_parents(repo_path: str, hashes: list[str]) -> dict[str, str]:
+    """
+    Return a hash -> first parent hash index for the given commits, with a
+    single git call. Commits without parents map to None.
+    """
+    command = ["git", "-C", repo_path, "rev-list", "--no-walk", "--parents", "--stdin"]
+    metrics.count("subprocesses")
+    result = subprocess.run(command, input = "\n".join(hashes), stdout = subprocess.PIPE, text = True)
+    parents = {}
+    for line in result.stdout.splitlines():
+        commit_hash, *commit_parents = line.split()
+        parents[commit_hash] = commit_parents[0] if commit_parents else None
+    return parents
+
+class EffortCollector(Collector):
+    """
+    TLOC of every refactoring commit, written to a CSV file per developer.
+    The refactoring commits and their parents are visited once, so the lines
+    of code of a commit are only counted once even if it is also the parent
+    of another refactoring commit. Changed files are read over a cat-file
+    reader that each process opens on first use.
+    """
+    stage = "effort"
+
+    def __init__(self, repo_path: str, output_dir: str, refactoring_hashes: list[str]):
+        self.output_dir = output_dir
+        self.refactoring_hashes = list(dict.fromkeys(refactoring_hashes))  # Remove duplicates
+        self.parents = get_first_parents(repo_path, self.refactoring_hashes) if self.refactoring_hashes else {}
+        super().__init__(set(self.refactoring_hashes) | {parent for parent in self.parents.values() if parent})
+        self.repo_path = repo_path
+        self.cat_file = None
+        self.locs = {}
+        self.developer_names = {}
+
+    def __getstate__(self): # Every worker process starts its own git processes
+        return {**self.__dict__, "cat_file": None}
+
+    def __exit__(self, type, value, traceback):
+        if self.cat_file is not None:
+            self.cat_file.close()
+        super().__exit__(type, value, traceback)
+
+    def extract(self, commit: Commit):
+        if self.cat_file is None:
+            self.cat_file = CatFile(self.repo_path)
+        developer_name = commit.author.name.replace(" ", "_") if commit.author else "Unknown"
+        return commit.hash, get_loc(commit, get_shared_cache(), self.cat_file), developer_name
+
+    def store(self, record):
+        commit_hash, loc, developer_name = record
+        self.locs[commit_hash] = loc
+        if commit_hash in self.parents:
+            self.developer_names[commit_hash] = developer_name
+
+    def flush(self):
+        get_shared_cache().flush()
+
+    def finish(self):
+        self.flush()
+
+        # Rows are buffered per developer so each file is opened only once
+        rows = {}
+        for commit_hash in self.refactoring_hashes:
+            developer_rows = rows.setdefault(self.developer_names.get(commit_hash, "Unknown"), [])
+
+            previous_commit_hash = self.parents.get(commit_hash)
+            if not previous_commit_hash:
+                print(f"Skipping commit {commit_hash} (no parents found)")
+                continue
+
+            tloc = abs(self.locs[commit_hash] - self.locs[previous_commit_hash])
+            developer_rows.append([commit_hash, previous_commit_hash, tloc])
+
+        for developer_name, developer_rows in rows.items():
+            output_file_path = os.path.join(self.output_dir, f"{developer_name}{EFFORT_FILE_SUFFIX}")
+            write_header = not os.path.exists(output_file_path) or os.path.getsize(output_file_path) == 0
             with open(output_file_path, "a", newline="") as csvfile:
                 writer = csv.writer(csvfile)
-
-                if os.path.getsize(output_file_path) == 0:
+                if write_header:
                     writer.writerow(["refactoring hash", "previous hash", "TLOC"])
+                writer.writerows(developer_rows)
+
+class DiffCollector(Collector):
+    """
+    Diffs of each commit, appended to the diff store as they are visited.
+    Diffs of a file longer than max_diff_size characters, like generated
+    files, are left out, their added and deleted line counts are kept. The
+    blob sizes of the changed files are looked up over a cat-file reader
+    first, and files larger than max_diff_size are left out of the patch
+    git computes, so they don't cost the time and memory of their diff.
+    """
+    stage = "diffs"
+
+    def __init__(self, diff_store: DiffStore, hashes: list[str], max_diff_size: int = None):
+        super().__init__(hashes)
+        self.diff_store = diff_store
+        self.max_diff_size = max_diff_size
+        self.append = None
+        self.cat_file = None
+
+    def __getstate__(self): # Worker processes only extract, the open files stay here
+        return {**self.__dict__, "appender": None, "append": None, "cat_file": None}
+
+    def __enter__(self):
+        self.appender = self.diff_store.appender()
+        self.append = self.appender.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.cat_file is not None:
+            self.cat_file.close()
+        self.appender.__exit__(type, value, traceback)
+
+    def large_files(self, commit: Commit) -> dict[str, tuple[str, int]]:
+        """
+        Path -> (path after the commit, size) of the changed files with a
+        blob before or after the commit larger than max_diff_size bytes
+        """
+        if self.cat_file is None:
+            self.cat_file = CatFile(commit.project_path)
+        large_files = {}
+        for path, old_blob, new_blob in self.cat_file.changed_files(commit.hash):
+            size = max(self.cat_file.info(blob)[2] for blob in (old_blob, new_blob) if blob)
+            if size > self.max_diff_size:
+                large_files[path] = (path if new_blob else None, size)
+        return large_files
+
+    def extract(self, commit: Commit):
+        diff_output = {
+            "commit_hash": commit.hash,
+            "diffs": []
+        }
+        large_files = self.large_files(commit) if self.max_diff_size is not None else {}
+        modified_files = get_modified_files(commit, exclude=large_files) if large_files else commit.modified_files
+        for file in modified_files:
+            diff = file.diff
+            file_output = {
+                "file": file.new_path,
+                "added": file.added_lines,
+                "deleted": file.deleted_lines,
+                "diff": diff
+            }
+            if self.max_diff_size is not None and len(diff) > self.max_diff_size:
+                file_output["diff"] = None
+                file_output["diff_omitted"] = len(diff)
+            diff_output["diffs"].append(file_output)
+
+        if large_files:
+            line_counts = get_line_counts(commit.project_path, commit.hash, large_files)
+            for path, (new_path, size) in large_files.items():
+                added, deleted = line_counts.get(path, (0, 0))
+                diff_output["diffs"].append({"file": new_path, "added": added, "deleted": deleted, "diff": None, "diff_omitted": size})
+        return diff_output
+
+    def store(self, record):
+        self.append(record)
+
+def get_modified_files(commit: Commit, exclude) -> list[ModifiedFile]:
+    """
+    Like pydriller's Commit.modified_files, without the paths in exclude,
+    whose patches git doesn't compute at all
+    """
+    paths = [f":(exclude,literal){path}" for path in exclude]
+    with Repo(commit.project_path) as repo:
+        git_commit = repo.commit(commit.hash)
+        if len(git_commit.parents) == 1:
+            diff_index = git_commit.parents[0].diff(other=git_commit, paths=paths, create_patch=True)
+        elif git_commit.parents: # Merge commits have no modified files
+            diff_index = []
+        else:
+            diff_index = git_commit.diff(NULL_TREE, paths=paths, create_patch=True)
+    return [ModifiedFile(diff=diff) for diff in diff_index]
+
+def get_line_counts(repo_path: str, commit_hash: str, paths) -> dict[str, tuple[int, int]]:
+    """
+    Path -> (added lines, deleted lines) of files a commit changed, counted
+    by git without printing their patch. Binary files count 0 lines.
+    """
+    command = ["git", "-C", repo_path, "diff-tree", "--root", "--no-commit-id", "-r", "-z", "--numstat", commit_hash, "--",
+        *(f":(literal){path}" for path in paths)]
+    metrics.count("subprocesses")
+    fields = subprocess.run(command, stdout = subprocess.PIPE, text = True, check = True).stdout.split("\0")
+    line_counts = {}
+    for field in fields:
+        if not field:
+            continue
+        added, deleted, path = field.split("\t", 2)
+        line_counts[path] = (int(added) if added != "-" else 0, int(deleted) if deleted != "-" else 0)
+    return line_counts
 
-                #for commit_hash in refactoring_hashes:
-                if commit_hash not in processed_hashes:
-                    # continue
-                    processed_hashes.add(commit_hash)
+def collect_developer_effort(repo_path: str, output_dir: str, refactoring_hashes: list[str]):
+    """
+    Write the TLOC of every refactoring commit to a CSV file per developer
+    """
+    traverse(repo_path, [EffortCollector(repo_path, output_dir, refactoring_hashes)])
 
-                    if not commit.parents:
-                        print(f"Skipping commit {commit_hash} (no parents found)")
-                        continue
-                    previous_commit_hash = commit.parents[0]
-                    previous_commit = gr.get_commit(previous_commit_hash)
+def run_refactoring_miner(dir_real_path:str, output_dir:str, miner:MinerPool, base:str = None, head:str = None) -> str:
+    """
+    Run RefactoringMiner on a repository on the miner pool. The whole history
+    is mined, or only the commits after base up to head if base is given.
+    Return the path of the output file.
+    """
+    output_path = os.path.join(os.path.realpath(output_dir), RMINER_NEW_OUTPUT_FILE if base else RMINER_OUTPUT_FILE)
+    if os.path.exists(output_path): # Left by an earlier run, don't mistake it for this run's output
+        os.remove(output_path)
+    if is_partial(dir_real_path):
+        # JGit can't download missing blobs, it would see the files as empty
+        print(f"{current_time()} - Fetched {fetch_missing_objects(dir_real_path)} missing objects of the partial clone")
+
+    if not base and miner.shards > 1:
+        hashes = get_hashes(dir_real_path)
+        if miner.should_shard(len(hashes)) and (plan := plan_shards(dir_real_path, hashes, miner.shards)):
+            run_sharded_refactoring_miner(dir_real_path, output_path, miner, *plan)
+            return output_path
+
+    mode = ["-bc", dir_real_path, base, head] if base else ["-a", dir_real_path]
+    metrics.count("subprocesses")
+    miner.run([*mode, "-json", output_path])
+    if not os.path.exists(output_path):
+        raise Exception(f"RefactoringMiner didn't write any output for {dir_real_path}")
+    return output_path
+
+def get_first_parent_hashes(repo_path: str) -> list[str]:
+    """
+    The first-parent history of HEAD, newest first
+    """
+    command = ["git", "-C", repo_path, "rev-list", "--topo-order", "--first-parent", "HEAD"]
+    metrics.count("subprocesses")
+    result = subprocess.run(command, stdout = subprocess.PIPE, text = True)
+    return result.stdout.splitlines()
 
-                    loc_current = get_loc(commit)
-                    loc_previous = get_loc(previous_commit)
-                    tloc = abs(loc_current - loc_previous)
+def get_range_hashes(repo_path: str, start: str, end: str) -> list[str]:
+    """
+    Commits RefactoringMiner's -bc mode mines for a range, those reachable
+    from end but not from start
+    """
+    command = ["git", "-C", repo_path, "rev-list", end, f"^{start}"]
+    metrics.count("subprocesses")
+    result = subprocess.run(command, stdout = subprocess.PIPE, text = True, check = True)
+    return result.stdout.splitlines()
 
-                    writer.writerow([commit_hash, previous_commit_hash, tloc])
+def split_into_ranges(hashes: list[str], shards: int) -> list[tuple[str, str]]:
+    """
+    Split the newest first first-parent history of HEAD into (start, end)
+    ranges for RefactoringMiner's -bc mode, which mines the commits after
+    start up to and including end. Every start is an ancestor of its end, so
+    a branch merged into a range is mined with that range only and the
+    ranges don't overlap. The oldest commit can't be an exclusive start of
+    its own, but it has no parent to compare to, so it has no refactorings
+    either. There are as many ranges as shards, unless the history has
+    fewer commits to start from.
+
+    >>> split_into_ranges(["e", "d", "c", "b", "a"], 2)
+    [('c', 'e'), ('a', 'c')]
+    >>> len(split_into_ranges([str(i) for i in range(10, 0, -1)], 4))
+    4
+    >>> split_into_ranges(["c", "b", "a"], 4)
+    [('b', 'c'), ('a', 'b')]
+    >>> split_into_ranges([], 2), split_into_ranges(["a"], 2)
+    ([], [])
+    """
+    bounds = sorted({index * max(len(hashes) - 1, 0) // shards for index in range(shards + 1)})
+    return [(hashes[start], hashes[end]) for end, start in zip(bounds, bounds[1:])]
 
-def mine_repo(repo_dir:str, output_dir:str, miner_path:str):
-    print(f"{current_time()} - Running RefactoringMiner...")
-    dir_real_path = os.path.realpath(repo_dir)
-    if not miner_path:
-        client = docker.from_env()
-        miner = client.containers.create("tsantalis/refactoringminer",
-            "-a /repo -json " + MINER_OUTPUT_FILE,
-            volumes={
-                dir_real_path: {"bind": "/repo", "mode": "rw"}
-            },
-            detach=True
-        )
-        miner.start()
-        miner.wait()
-        bits, stat = miner.get_archive("diff/" + MINER_OUTPUT_FILE) # Get output file from exited container as a tarfile
-        miner.remove()
-
-        file = open(TAR_FILE, "wb") #Open file for writing output bits
-        for chunk in bits:
-            file.write(chunk)
-        file.close()
-
-        output_tar = tarfile.open(TAR_FILE, "r") #Extract json object from tarfile
-        output_json = output_tar.extractfile(MINER_OUTPUT_FILE).read()
-        output_tar.close()
-        json_obj = json.loads(output_json)
-
-        with open(os.path.join(output_dir, "rminer-output.json"), "w") as rminer_file:
-            json.dump(json_obj, rminer_file)
-
-        os.remove(TAR_FILE)
-
-    else:
-        subprocess.call(
-            [miner_path, "-a", dir_real_path, "-json", os.path.join(os.path.realpath(output_dir), "rminer-output.json")],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
-        )
-
-        with open(os.path.join(os.path.realpath(output_dir), "rminer-output.json"), "r") as rminer_file:
-            json_obj = json.loads(rminer_file.read())
+def plan_shards(repo_path: str, hashes: list[str], shards: int):
+    """
+    Commit ranges of the shards, and the commits of hashes none of them
+    reaches, like branches that weren't merged into HEAD, which are mined
+    one at a time. None if those are more than a shard's worth, mining them
+    one at a time would cost more than mining the whole history at once.
+    """
+    first_parent_hashes = get_first_parent_hashes(repo_path)
+    ranges = split_into_ranges(first_parent_hashes, shards)
+    if not ranges:
+        return None
+    if len(ranges) < shards:
+        print(f"{current_time()} - Only {len(ranges)} of {shards} shards, the first-parent history has {len(first_parent_hashes)} commits")
+    covered = set()
+    for start, end in ranges:
+        covered.update(get_range_hashes(repo_path, start, end))
+    uncovered = [commit_hash for commit_hash in hashes if commit_hash not in covered]
+    # Commits without a parent have nothing to compare to
+    parents = get_first_parents(repo_path, uncovered) if uncovered else {}
+    missing = [commit_hash for commit_hash in uncovered if parents.get(commit_hash)]
+    if len(missing) > len(hashes) // len(ranges):
+        print(f"{current_time()} - {len(missing)} commits are outside the first-parent history, not sharding")
+        return None
+    return ranges, missing
+
+def run_sharded_refactoring_miner(dir_real_path:str, output_path:str, miner:MinerPool, ranges:list[tuple[str, str]],
+        missing:list[str]):
+    """
+    Mine the commit ranges of a large repository concurrently, each against
+    its own clone, and the missing commits no range reaches one at a time.
+    The outputs don't overlap, and they are merged newest first by commit
+    date like a single run lists them, so the time between refactorings
+    is computed from the same order.
+    """
+    print(f"{current_time()} - Mining in {len(ranges)} shards and {len(missing)} single commits...")
+    shard_dirs = [f"{dir_real_path}-shard{index}" for index in range(len(ranges))]
+    shard_outputs = [f"{output_path}.shard{index}" for index in range(len(ranges))]
+    commit_outputs = [f"{output_path}.commit{index}" for index in range(len(missing))]
+
+    def mine_shard(index):
+        start, end = ranges[index]
+        # RefactoringMiner reads commits from the object database, no checkout is needed
+        metrics.count("subprocesses", 2)
+        subprocess.run(["git", "clone", "--quiet", "--local", "--no-checkout", dir_real_path, shard_dirs[index]], check=True)
+        miner.run(["-bc", shard_dirs[index], start, end, "-json", shard_outputs[index]])
+        if not os.path.exists(shard_outputs[index]):
+            raise Exception(f"RefactoringMiner didn't write any output for shard {index} ({start}..{end})")
+
+    def mine_commit(index):
+        metrics.count("subprocesses")
+        miner.run(["-c", dir_real_path, missing[index], "-json", commit_outputs[index]])
+        if not os.path.exists(commit_outputs[index]):
+            raise Exception(f"RefactoringMiner didn't write any output for commit {missing[index]}")
+
+    try:
+        # Jobs wait for a free miner, the threads only bound how many are queued
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            shard_jobs = executor.map(metrics.in_this_repository(mine_shard), range(len(ranges)))
+            commit_jobs = executor.map(metrics.in_this_repository(mine_commit), range(len(missing)))
+            list(shard_jobs)
+            list(commit_jobs)
+
+        dates = {commit_hash: date for commit_hash, _, date in export.read_commit_log(dir_real_path)}
+
+        def read_commits(paths):
+            for path in paths:
+                with open(path, "r", encoding="utf-8") as shard_file:
+                    yield from jsonstream.iter_array(shard_file, "commits")
+
+        # Every output is newest first, only their heads are in memory while they are merged
+        by_date = lambda index: dates[missing[index]]
+        missing_outputs = [commit_outputs[index] for index in sorted(range(len(missing)), key=by_date, reverse=True)]
+        outputs = [read_commits([path]) for path in shard_outputs] + [read_commits(missing_outputs)]
+        merged_commits = heapq.merge(*outputs, key=lambda commit: dates[commit["sha1"]], reverse=True)
+
+        with open(output_path + ".tmp", "w", encoding="utf-8") as merged_file:
+            merged_file.write('{"commits":')
+            jsonstream.write_array(merged_file, merged_commits)
+            merged_file.write("}")
+        os.replace(output_path + ".tmp", output_path)
+    finally:
+        for shard_dir in shard_dirs:
+            if os.path.exists(shard_dir):
+                remove_tree(shard_dir)
+        for path in shard_outputs + commit_outputs:
+            if os.path.exists(path):
+                os.remove(path)
+
+def merge_rminer_output(output_dir:str, repo_dir:str):
+    """
+    Put the commits of an incremental RefactoringMiner run in front of the
+    earlier output, so that the newest commit still comes first. Commits
+    that are no longer in the repository, like those of a branch deleted
+    upstream and pruned from the mirror, are dropped.
+
+    >>> import tempfile, benchmark
+    >>> repo_dir, output_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> benchmark.make_synthetic_repo(repo_dir, 2, 1, 1, 1)
+    >>> git = ["git", "-C", repo_dir, "-c", "user.name=A", "-c", "user.email=a@example.com"]
+    >>> def commit(parent, message):
+    ...     return subprocess.run([*git, "commit-tree", f"{parent}^{{tree}}", "-p", parent, "-m", message],
+    ...         stdout=subprocess.PIPE, text=True, check=True).stdout.strip()
+    >>> def write_output(file_name, hashes):
+    ...     with open(os.path.join(output_dir, file_name), "w") as rminer_file:
+    ...         json.dump({"commits": [{"sha1": h, "refactorings": [{"type": "Rename Method"}]} for h in hashes]}, rminer_file)
+    >>> branch = commit("HEAD", "Branch")
+    >>> _ = subprocess.run([*git, "branch", "feature", branch], check=True)
+    >>> write_output(RMINER_OUTPUT_FILE, [branch, *get_hashes(repo_dir)[1:]])
+    >>> _ = subprocess.run([*git, "branch", "-D", "--quiet", "feature"], check=True)
+    >>> head = commit("HEAD", "After the branch was deleted")
+    >>> _ = subprocess.run([*git, "update-ref", "HEAD", head], check=True)
+    >>> write_output(RMINER_NEW_OUTPUT_FILE, [head])
+    >>> merge_rminer_output(output_dir, repo_dir)
+    >>> summarize_refactorings(repo_dir, output_dir) == get_hashes(repo_dir)
+    True
+    """
+    new_path = os.path.join(output_dir, RMINER_NEW_OUTPUT_FILE)
+    output_path = os.path.join(output_dir, RMINER_OUTPUT_FILE)
+    reachable = set(get_hashes(repo_dir))
+
+    def all_commits():
+        for path in (new_path, output_path):
+            with open(path, "r", encoding="utf-8") as rminer_file:
+                for commit in jsonstream.iter_array(rminer_file, "commits"):
+                    if commit["sha1"] in reachable:
+                        yield commit
+
+    with open(output_path + ".tmp", "w", encoding="utf-8") as merged_file:
+        merged_file.write('{"commits":')
+        jsonstream.write_array(merged_file, all_commits())
+        merged_file.write("}")
+    os.replace(output_path + ".tmp", output_path)
+    os.remove(new_path)
+
+def remove_developer_effort(output_dir:str):
+    for file_name in os.listdir(output_dir):
+        if file_name.endswith(EFFORT_FILE_SUFFIX):
+            os.remove(os.path.join(output_dir, file_name))
+
+def get_head(repo_dir:str) -> str:
+    command = ["git", "-C", repo_dir, "rev-parse", "HEAD"]
+    metrics.count("subprocesses")
+    return subprocess.run(command, stdout = subprocess.PIPE, text = True).stdout.strip()
+
+def get_remote_head(url:str) -> str:
+    """
+    HEAD of a remote repository without cloning it, None if it can't be read
+    """
+    command = ["git", "ls-remote", url, "HEAD"]
+    result = subprocess.run(command, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, text = True)
+    return result.stdout.split()[0] if result.returncode == 0 and result.stdout else None
 
-    print(f"{current_time()} - Parsing output from RefactoringMiner...")
+def get_hashes_since(repo_dir:str, base:str):
+    """
+    Set of commits reachable from HEAD but not from base. None if base is not
+    set or no longer exists in the repository, meaning everything is new.
+    """
+    if base is None:
+        return None
+    command = ["git", "-C", repo_dir, "rev-list", f"{base}..HEAD"]
+    metrics.count("subprocesses")
+    result = subprocess.run(command, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, text = True)
+    return set(result.stdout.splitlines()) if result.returncode == 0 else None
+
+def summarize_refactorings(repo_dir:str, output_dir:str) -> list[str]:
+    """
+    Write refactorings.json and the refactoring timeline from the
+    RefactoringMiner output and return the hashes of commits with
+    refactorings. This is a single pass over the whole output, so it is
+    redone from scratch after every run.
+    """
     #Count different commit types to a directory. Also calculate time between commits average
     refactorings = {}
     previous_refactor_date = None
     refactor_date_difference_sum = timedelta()
     refactor_count = 0
     refactoring_hashes = []
+    commit_log = {commit_hash: (author, date) for commit_hash, author, date in export.read_commit_log(repo_dir)}
+    timeline = TimelineBuilder()
 
-    for commit in json_obj["commits"]:
-        if len(commit["refactorings"]) > 0:
+    # The output can be hundreds of megabytes, so commits are read one at a time
+    with open(os.path.join(output_dir, RMINER_OUTPUT_FILE), "r", encoding="utf-8") as rminer_file:
+        for commit in jsonstream.iter_array(rminer_file, "commits"):
             commit_hash = commit["sha1"]
-            refactoring_hashes.append(commit_hash)
-
-        for refactoring in commit["refactorings"]:
-            commit_date = get_commit_date(repo_dir, commit_hash)
-            if previous_refactor_date:
-                #First commit in list is the latest commit, do substraction accordingly
-                refactor_date_difference_sum += previous_refactor_date - commit_date
-
-            previous_refactor_date = commit_date
-            refactor_count += 1
-            type = refactoring["type"]
-            refactorings[type] = refactorings.get(type, 0) + 1 #Increment count for refactoring type
-
-    time_between_refactors = 0
+            if commit_hash not in commit_log:
+                continue # Left in an output merged before its branch was pruned
+            if len(commit["refactorings"]) > 0:
+                refactoring_hashes.append(commit_hash)
+
+            for refactoring in commit["refactorings"]:
+                author, commit_date = commit_log[commit_hash]
+                if previous_refactor_date:
+                    #First commit in list is the latest commit, do substraction accordingly
+                    refactor_date_difference_sum += previous_refactor_date - commit_date
+
+                previous_refactor_date = commit_date
+                refactor_count += 1
+                type = refactoring["type"]
+                refactorings[type] = refactorings.get(type, 0) + 1 #Increment count for refactoring type
+                timeline.add(commit_date.timestamp(), type, author)
+
+    time_between_refactors = timedelta()
     if len(refactorings) > 0: #Print output for now, get prettier output in the future
         time_between_refactors = refactor_date_difference_sum / refactor_count
 
+    timeline = timeline.build()
+    timeline.save(os.path.join(output_dir, TIMELINE_FILE))
     with open(os.path.join(output_dir, "refactorings.json"), "w") as refactorings_file:
         output = {
             "refactorings": refactorings,
-            "average_time_between_refactors": str(time_between_refactors)
+            "average_time_between_refactors": str(time_between_refactors),
+            "average_seconds_between_refactors": time_between_refactors.total_seconds(),
+            "seconds_between_refactors": timeline.summary()
         }
         json.dump(output, refactorings_file)
+    return refactoring_hashes
 
-    print(f"{current_time()} - Collecting diffs...")
-    diffs = collect_diffs(dir_real_path, refactoring_hashes)
-    with open(os.path.join(output_dir, "diffs.json"), "w") as diffs_file:
-        json.dump(diffs, diffs_file)
-
-    print(f"{current_time()} - Collecting developer effort...")
-    collect_developer_effort(repo_dir, output_dir, refactoring_hashes)
-
+def pending_diff_hashes(repo_dir:str, progress:RepositoryProgress, diff_store:DiffStore, refactoring_hashes:list[str]) -> list[str]:
+    """
+    Refactoring commits whose diffs are still to be collected: those after
+    the HEAD diffs were last collected for, without the ones an interrupted
+    or deferred run already stored. The store only starts over if that HEAD
+    is gone, like after a force push.
+
+    A repository deferred in its first run keeps its diffs for --deferred:
+    >>> import tempfile
+    >>> state = StateStore(":memory:")
+    >>> diff_store = DiffStore(tempfile.mkdtemp())
+    >>> diff_store.write({"commit_hash": "a", "diffs": []})
+    >>> state.defer("repo", "https://github.com/apache/repo", "commits", "timed out")
+    >>> pending_diff_hashes(".", state.progress("repo", "c"), diff_store, ["c", "b", "a"])
+    ['c', 'b']
+    >>> "a" in diff_store
+    True
+    """
+    base = progress.base("diffs")
+    new_hashes = get_hashes_since(repo_dir, base)
+    if base is not None and new_hashes is None:
+        diff_store.clear()
+    return [h for h in refactoring_hashes if (new_hashes is None or h in new_hashes) and h not in diff_store]
+
+def mine_repo(repo_dir:str, output_dir:str, miner:MinerPool, limits:StageLimits = NO_LIMITS, progress:RepositoryProgress = None,
+        processes:int = 1, max_diff_size:int = None):
+    """
+    Run the mining stages for a repository. Stages that progress says are
+    done for the current HEAD are skipped, and the others only process
+    commits after the HEAD they were last run for. Commits are traversed by
+    a pool of processes if processes is more than 1.
+    """
+    dir_real_path = os.path.realpath(repo_dir)
+    if progress is None: # Mine everything from scratch
+        progress = StateStore(":memory:").progress(os.path.basename(dir_real_path), get_head(repo_dir))
+
+    if not progress.is_done("rminer"):
+        print(f"{current_time()} - Running RefactoringMiner...")
+        base = progress.base("rminer")
+        if get_hashes_since(repo_dir, base) is None or not os.path.exists(os.path.join(output_dir, RMINER_OUTPUT_FILE)):
+            base = None # Nothing to build on, mine the whole history
+        with limits.cpu, metrics.stage("rminer"):
+            run_refactoring_miner(dir_real_path, output_dir, miner, base, progress.head)
+            if base:
+                merge_rminer_output(output_dir, repo_dir)
+        progress.finish("rminer")
 
-def collect_diffs(path, hashes):
-    out = []
-    for commit in PyDriller(path, only_commits=hashes).traverse_commits():
-        diff_output = {
-            "commit_hash": commit.hash,
-            "diffs": []
-        }
-        for file in commit.modified_files:
-            diff_output["diffs"].append({
-                "file": file.new_path,
-                "added": file.added_lines,
-                "deleted": file.deleted_lines,
-                "diff": file.diff
-            })
-        out.append(diff_output)
-    return out
+    print(f"{current_time()} - Parsing output from RefactoringMiner...")
+    with metrics.stage("parse"):
+        refactoring_hashes = summarize_refactorings(repo_dir, output_dir)
+    progress.finish("refactorings")
+
+    # Diffs and developer effort are collected in one traversal of the commits
+    collectors = []
+    if not progress.is_done("diffs"):
+        diff_store = DiffStore(output_dir)
+        hashes = pending_diff_hashes(repo_dir, progress, diff_store, refactoring_hashes)
+        collectors.append(DiffCollector(diff_store, hashes, max_diff_size))
+
+    if not progress.is_done("effort"):
+        new_hashes = get_hashes_since(repo_dir, progress.base("effort"))
+        if new_hashes is None:
+            remove_developer_effort(output_dir) # Rows are appended, start over from empty files
+        hashes = [h for h in refactoring_hashes if new_hashes is None or h in new_hashes]
+        collectors.append(EffortCollector(repo_dir, output_dir, hashes))
+
+    if collectors:
+        print(f"{current_time()} - Collecting {', '.join(collector.stage for collector in collectors)}...")
+        with limits.cpu, metrics.stage("commits"):
+            traverse(dir_real_path, collectors, processes, limits.commits_timeout, limits.commits_memory)
+        for collector in collectors:
+            progress.finish(collector.stage)
+
+def collect_diffs(path, hashes, diff_store: DiffStore, processes: int = 1, max_diff_size: int = None):
+    """
+    Write the diffs of each commit to diff_store as it is traversed
+
+    A pooled traversal stores them in the same order as a serial one:
+    >>> import tempfile, benchmark
+    >>> repo_dir = tempfile.mkdtemp()
+    >>> benchmark.make_synthetic_repo(repo_dir, 40, 1, 1, 1)
+    >>> hashes = get_hashes(repo_dir)[:30]
+    >>> serial, pooled = DiffStore(tempfile.mkdtemp()), DiffStore(tempfile.mkdtemp())
+    >>> collect_diffs(repo_dir, hashes, serial)
+    >>> collect_diffs(repo_dir, hashes, pooled, processes=2)
+    >>> [record["commit_hash"] for record in serial] == [record["commit_hash"] for record in pooled] == hashes
+    True
+    """
+    traverse(path, [DiffCollector(diff_store, hashes, max_diff_size)], processes)
 
-def get_commit_date(git_dir: str, hash: str) -> datetime:
+def get_commit_date(git_dir: str, hash: str, cat_file: CatFile = None) -> datetime:
     """
-    Return date and time for a commit in a git directory
+    Return date and time for a commit in a git directory. With cat_file the
+    commit is read over its pipes instead of starting git show.
     """
+    if cat_file is not None:
+        return cat_file.commit(hash).committer_date
+    metrics.count("subprocesses")
     p = subprocess.Popen(
         ["git", "-C", git_dir, "show", "--no-patch", "--format=%ci", hash],
         stdout=subprocess.PIPE,
@@ -200,32 +714,160 @@ def get_commit_date(git_dir: str, hash: str) -> datetime:
     )
     return datetime.strptime(p.stdout.read().strip(), "%Y-%m-%d %H:%M:%S %z")
 
-def main():
-    urls = urlparser.list_project_urls("./sonar_measures.csv")
-    if len(sys.argv) > 1:
-        refactoringMinerPath = sys.argv[1]
-    else:
-        refactoringMinerPath = None
-    
-    for url in urls:
-        try:
-           with Repository(url) as (dir_name, repo_name):
-                current_dir = os.path.dirname(__file__)
-                output_dir = os.path.join(current_dir, "output", repo_name)
-
-                # If the directory exists (i.e. we have already mined it) we
-                # just catch an error and move to the next repository.
-                os.makedirs(output_dir)
-
-                print(f"Mining the {repo_name} repository...")
-                mine_repo(dir_name, output_dir, refactoringMinerPath)
+def mine_url(url:str, miner:MinerPool, state:StateStore, limits:StageLimits = NO_LIMITS, processes:int = 1, max_diff_size:int = None,
+        mine_issues:bool = True, **clone_options):
+    """
+    Clone, mine and collect issues for a single repository.
+    Repositories whose HEAD hasn't moved since they were mined are skipped
+    without cloning them. Without mine_issues the issues are left to
+    issue_client.py.
+    """
+    if state.is_up_to_date(repository_name(url), get_remote_head(url)):
+        print(f"{current_time()} - Already up to date: {url}")
+        return
+
+    repo_name = repository_name(url)
+    output_dir = os.path.join(OUTPUT_ROOT, repo_name)
+    os.makedirs(output_dir, exist_ok=True)
 
+    with metrics.repository(repo_name, output_dir):
+        with limits.network, metrics.stage("clone"):
+            repository = Repository(url, **clone_options)
+
+        with repository as (dir_name, repo_name):
+            progress = state.progress(repo_name, get_head(dir_name))
+
+            print(f"Mining the {repo_name} repository...")
+            mine_repo(dir_name, output_dir, miner, limits, progress, processes, max_diff_size)
+
+            if mine_issues and not progress.is_done("issues"):
                 print(f"{current_time()} - Mining issue data...")
-                issues.mine_issue_data(url, output_dir)
+                with limits.network:
+                    issues.mine_issue_data(url, output_dir)
+                progress.finish("issues")
+
+            if not progress.is_done("links"):
+                print(f"{current_time()} - Linking refactoring commits with issues...")
+                with metrics.stage("links"):
+                    link_count = links.link_repository(dir_name, output_dir)
+                print(f"{current_time()} - Found {link_count} links")
+                progress.finish("links")
+
+            if not progress.is_done("export"):
+                with metrics.stage("export"):
+                    export.export_repository(repo_name, output_dir, dir_name)
+                progress.finish("export")
+
+            print(f"{current_time()} - Success!\n")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mine refactorings, diffs, developer effort and issues of Apache repositories")
+    parser.add_argument("miner_path", nargs="?", default=None,
+        help="path to a local RefactoringMiner launcher, Docker is used if left out")
+    parser.add_argument("--projects", default=urlparser.SONAR_MEASURES_FILE,
+        help="CSV file with a project column listing the repositories (default: ./sonar_measures.csv)")
+    parser.add_argument("--url-shard", default=None,
+        help="mine only shard i/n of the repositories, e.g. 0/4 on the first of four machines")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+        help="number of repositories mined at the same time (default: 4)")
+    parser.add_argument("--network-jobs", type=int, default=4,
+        help="max concurrent clones and issue fetches (default: 4)")
+    parser.add_argument("--cpu-jobs", type=int, default=2,
+        help="max concurrent RefactoringMiner and PyDriller stages (default: 2)")
+    parser.add_argument("--miner-timeout", type=float, default=6 * 60 * 60,
+        help="seconds a RefactoringMiner job may run before it is killed (default: 6 hours)")
+    parser.add_argument("--miner-memory", type=int, default=None,
+        help="megabytes a RefactoringMiner job may use (default: no limit)")
+    parser.add_argument("--commits-timeout", type=float, default=None,
+        help="seconds the commit traversal of a repository may run (default: no limit)")
+    parser.add_argument("--commits-memory", type=int, default=None,
+        help="megabytes each --commit-processes process and each git command it starts may use (default: no limit)")
+    parser.add_argument("--deferred", action="store_true",
+        help="mine only the repositories deferred for running over a budget, without the budgets")
+    parser.add_argument("--shards", type=int, default=1,
+        help="split the history of large repositories into this many commit ranges mined in parallel (default: 1)")
+    parser.add_argument("--shard-min-commits", type=int, default=20000,
+        help="only repositories with at least this many commits are sharded (default: 20000)")
+    parser.add_argument("--commit-processes", type=int, default=1,
+        help="processes extracting diffs and lines of code of commits, per --cpu-jobs slot (default: 1, no pool)")
+    parser.add_argument("--max-diff-size", type=int, default=None,
+        help="leave out diffs of a file longer than this many characters, like generated files, files larger than that aren't diffed at all (default: no limit)")
+    parser.add_argument("--skip-issues", action="store_true",
+        help="don't collect issues while mining, run issue_client.py for them instead")
+    parser.add_argument("--queue", default=None,
+        help="share the repositories between nodes through this queue, an SQLite file on shared storage or a redis:// URL")
+    parser.add_argument("--coordinator", action="store_true",
+        help="fill the --queue with the repositories and report progress instead of mining")
+    parser.add_argument("--worker-name", default=f"{socket.gethostname()}-{os.getpid()}",
+        help="name of this node in the queue (default: host name and process id)")
+    parser.add_argument("--lease", type=float, default=workqueue.LEASE_SECONDS,
+        help="seconds a claimed repository stays leased without a heartbeat (default: 15 minutes)")
+    parser.add_argument("--max-attempts", type=int, default=workqueue.MAX_ATTEMPTS,
+        help="times a repository is tried before it is failed (default: 3)")
+    parser.add_argument("--upload-dir", default=None,
+        help="copy the output of every mined repository here, like shared storage")
+    parser.add_argument("--cache-dir", default=CACHE_DIR,
+        help="directory for the repository mirror cache (default: ./cache)")
+    parser.add_argument("--cache-size", type=float, default=None,
+        help="disk budget of the mirror cache in gigabytes, least recently used mirrors are evicted (default: unlimited)")
+    parser.add_argument("--partial-clone", action="store_true",
+        help="clone mirrors with --filter=blob:none, file contents are downloaded when first needed")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    queue = workqueue.open_queue(args.queue, args.max_attempts) if args.queue else None
+    os.makedirs(OUTPUT_ROOT, exist_ok=True)
+    os.makedirs(args.cache_dir, exist_ok=True)
+    state = StateStore(os.path.join(OUTPUT_ROOT, STATE_FILE))
+
+    if args.deferred:
+        queue = None # Deferred repositories are recorded in this node's state
+        urls = state.deferred_urls()
+        print(f"{len(urls)} repositories were deferred.\n")
+        args.miner_timeout = args.miner_memory = args.commits_timeout = args.commits_memory = None
+    elif queue is None or args.coordinator:
+        urls = urlparser.list_project_urls(args.projects, args.url_shard)
+    if queue is None or args.coordinator:
+        # Longest first, the queue hands them out in the order they were added
+        urls = order_by_cost(urls, args.workers, args.cache_dir)
+    if args.coordinator:
+        if queue is None:
+            raise SystemExit("--coordinator needs a --queue")
+        workqueue.run_coordinator(queue, urls)
+        return
+
+    limits = StageLimits(args.network_jobs, args.cpu_jobs, args.commits_timeout, args.commits_memory)
+
+    clone_options = {
+        "cache_dir": args.cache_dir,
+        "partial": args.partial_clone,
+        "cache_budget": int(args.cache_size * 1024 ** 3) if args.cache_size else None
+    }
 
-                print(f"{current_time()} - Success!\n")
-        except Exception as e:
-            print(e)
+    # The miners see the worktrees and the outputs at the same paths as we do
+    with MinerPool(args.cpu_jobs, [args.cache_dir, OUTPUT_ROOT], args.miner_path, args.miner_timeout,
+            shards=args.shards, shard_min_commits=args.shard_min_commits, memory_limit=args.miner_memory) as miner:
+        def mine(url):
+            repo_name = repository_name(url)
+            if state.is_deferred(repo_name) and not args.deferred:
+                print(f"{current_time()} - Deferred, mine it with --deferred: {url}")
+                return
+            try:
+                mine_url(url, miner, state, limits, args.commit_processes, args.max_diff_size, not args.skip_issues, **clone_options)
+            except OverBudget as e:
+                # The stages it finished and the commits it collected are kept for the deferred run
+                print(f"{current_time()} - Deferring {url}, {e}")
+                state.defer(repo_name, url, e.stage, str(e))
+                return
+            state.undefer(repo_name)
+            if args.upload_dir:
+                workqueue.upload(os.path.join(OUTPUT_ROOT, repo_name), args.upload_dir)
+
+        if queue:
+            workqueue.run_worker(queue, mine, args.worker_name, args.workers, args.lease)
+        else:
+            run_parallel(mine, urls, args.workers)
 
 if __name__ == "__main__":
     main()
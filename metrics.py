@@ -0,0 +1,150 @@
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+METRICS_FILE = os.path.join(os.path.dirname(__file__), "output", "metrics.jsonl")
+
+# The repository being mined by the current thread
+current = threading.local()
+write_lock = threading.Lock()
+
+def peak_rss_kb():
+    """
+    Peak resident set size of this process and of its finished child
+    processes (git, RefactoringMiner) in kilobytes
+    """
+    if resource is None:
+        return None, None
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+
+class RepositoryMetrics(object):
+    """
+    Stage by stage measurements of mining one repository: monotonic duration,
+    peak memory, subprocess and API call counts and bytes written to the
+    output directory. Peak memory is per process, so with parallel workers
+    it tells the high water mark at the end of the stage, not the stage's own.
+    """
+    def __init__(self, repo_name, output_dir=None):
+        self.repo_name = repo_name
+        self.output_dir = output_dir
+        self.started_at = datetime.now().isoformat()
+        self.stages = {}
+        self.stage_name = None
+        self.error = None
+        self.lock = threading.Lock() # Thread pool workers count into the same stage
+
+    @contextmanager
+    def stage(self, name):
+        record = self.stages.setdefault(name, {
+            "seconds": 0.0, "subprocesses": 0, "api_calls": 0, "bytes_written": 0
+        })
+        size_before = self.output_size()
+        start = time.monotonic()
+        outer_stage = self.stage_name
+        self.stage_name = name
+        try:
+            yield record
+        finally:
+            self.stage_name = outer_stage
+            record["seconds"] += time.monotonic() - start
+            record["bytes_written"] += max(0, self.output_size() - size_before)
+            record["peak_rss_kb"], record["children_peak_rss_kb"] = peak_rss_kb()
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            if self.stage_name is not None:
+                self.stages[self.stage_name][counter] += amount
+
+    def output_size(self):
+        from repository import directory_size # repository imports this module
+        return directory_size(self.output_dir) if self.output_dir else 0
+
+    def to_json(self):
+        return {
+            "repository": self.repo_name,
+            "started_at": self.started_at,
+            "total_seconds": sum(stage["seconds"] for stage in self.stages.values()),
+            "error": self.error,
+            "stages": self.stages
+        }
+
+    def write(self, path=METRICS_FILE):
+        with write_lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a") as metrics_file:
+                metrics_file.write(json.dumps(self.to_json()) + "\n")
+
+@contextmanager
+def repository(repo_name, output_dir=None, path=METRICS_FILE):
+    """
+    Record the stages run by this thread for a repository, the metrics are
+    written as one JSON line when the block exits, also if it fails
+    """
+    metrics = RepositoryMetrics(repo_name, output_dir)
+    previous = getattr(current, "metrics", None)
+    current.metrics = metrics
+    try:
+        yield metrics
+    except Exception as e:
+        metrics.error = str(e)
+        raise
+    finally:
+        current.metrics = previous
+        metrics.write(path)
+
+@contextmanager
+def stage(name):
+    """
+    Measure a stage of the repository being mined by this thread.
+    Does nothing if no repository is being recorded.
+    """
+    metrics = getattr(current, "metrics", None)
+    if metrics is None:
+        yield None
+        return
+    with metrics.stage(name) as record:
+        yield record
+
+def count(counter, amount=1):
+    """
+    Add to a counter ("subprocesses" or "api_calls") of the current stage
+    """
+    metrics = getattr(current, "metrics", None)
+    if metrics is not None:
+        metrics.count(counter, amount)
+
+def in_this_repository(function):
+    """
+    Wrap a function that is run on another thread, like a thread pool
+    worker, so that what it counts goes to this thread's repository
+    """
+    metrics = getattr(current, "metrics", None)
+
+    def wrapper(*args, **kwargs):
+        previous = getattr(current, "metrics", None)
+        current.metrics = metrics
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current.metrics = previous
+    return wrapper
+
+def read_metrics(path=METRICS_FILE):
+    """
+    Yield every metrics line, a repository has one line per run that mined it
+    """
+    with open(path, "r") as metrics_file:
+        for line in metrics_file:
+            yield json.loads(line)
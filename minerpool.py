@@ -0,0 +1,180 @@
+import os
+import queue
+import subprocess
+import threading
+import time
+
+from concurrent.futures import Future
+
+from cost import OverBudget
+
+IMAGE = "tsantalis/refactoringminer"
+TIMEOUT_EXIT_CODE = 124 # Exit code of coreutils timeout
+OUT_OF_MEMORY_EXIT_CODE = 3 # Exit code of the JVM with -XX:+ExitOnOutOfMemoryError
+HEAP_SHARE = 0.75 # Of the memory limit, the rest is for the JVM itself and git
+
+class MinerJobTimeout(OverBudget):
+    def __init__(self, message):
+        super().__init__("rminer", message)
+
+class MinerOutOfMemory(OverBudget):
+    def __init__(self, message):
+        super().__init__("rminer", message)
+
+class MinerPool(object):
+    """
+    A fixed number of RefactoringMiner workers that take jobs from a queue.
+
+    With Docker, every worker owns a container that is started once and kept
+    running. Jobs are run in it with exec, so a job doesn't pay for creating
+    and removing a container. The shared directories are bind-mounted at the
+    same paths inside the containers, so the miner reads the repositories
+    and writes its output straight to the host and no path has to be
+    translated. A container that has stopped is replaced before the next job.
+
+    With a local installation (miner_path set) every job is a launcher
+    process, RefactoringMiner has no mode that would keep one JVM serving
+    many repositories.
+
+    Jobs running longer than job_timeout seconds are killed and raise
+    MinerJobTimeout, so one pathological repository doesn't block a worker.
+    With memory_limit (megabytes) the miner's heap is capped at part of it,
+    and the containers at all of it, a job running out raises
+    MinerOutOfMemory.
+
+    Repositories with at least shard_min_commits commits are split into
+    shards commit ranges that are mined in parallel.
+    """
+    def __init__(self, size, shared_dirs, miner_path=None, job_timeout=None, image=IMAGE, shards=1, shard_min_commits=None,
+            memory_limit=None):
+        self.miner_path = miner_path
+        self.job_timeout = job_timeout
+        self.memory_limit = memory_limit
+        self.shards = shards
+        self.shard_min_commits = shard_min_commits
+        self.image = image
+        self.shared_dirs = [os.path.realpath(path) for path in shared_dirs]
+        self.jobs = queue.Queue()
+        self.client = None
+        self.entrypoint = None
+        if not miner_path:
+            import docker
+            self.client = docker.from_env()
+            config = self.client.images.get(image).attrs["Config"]
+            self.entrypoint = config["Entrypoint"]
+            self.working_dir = config.get("WorkingDir") or None
+
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(size)]
+        for worker in self.workers:
+            worker.start()
+
+    def run(self, args):
+        """
+        Run RefactoringMiner with args on the next free worker and wait for it
+        """
+        future = Future()
+        self.jobs.put((args, future))
+        return future.result()
+
+    def should_shard(self, commit_count):
+        return self.shards > 1 and commit_count >= (self.shard_min_commits or 0)
+
+    def java_environment(self):
+        """
+        Environment for the miner's JVM, which every launcher passes on
+        """
+        if not self.memory_limit:
+            return {}
+        heap = int(self.memory_limit * HEAP_SHARE)
+        return {"JAVA_TOOL_OPTIONS": f"-Xmx{heap}m -XX:+ExitOnOutOfMemoryError"}
+
+    def out_of_memory(self):
+        return MinerOutOfMemory(f"RefactoringMiner ran out of its {self.memory_limit} MB")
+
+    def close(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def work(self):
+        container = None
+        try:
+            while (job := self.jobs.get()) is not None:
+                args, future = job
+                try:
+                    if self.client:
+                        container = self.healthy_container(container)
+                        future.set_result(self.run_in_container(container, args))
+                    else:
+                        future.set_result(self.run_locally(args))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            if container:
+                container.remove(force=True)
+
+    def start_container(self):
+        volumes = {path: {"bind": path, "mode": "rw"} for path in self.shared_dirs}
+        container = self.client.containers.run(
+            self.image,
+            entrypoint=["sleep", "infinity"], # Keep the container idle between jobs
+            volumes=volumes,
+            working_dir=self.working_dir,
+            mem_limit=f"{int(self.memory_limit)}m" if self.memory_limit else None,
+            detach=True
+        )
+        print(f"Started RefactoringMiner container {container.short_id}")
+        return container
+
+    def healthy_container(self, container):
+        """
+        The worker's container, replaced with a new one if it isn't running
+        """
+        if container is not None:
+            try:
+                container.reload()
+                if container.status == "running":
+                    return container
+                print(f"RefactoringMiner container {container.short_id} is {container.status}, restarting")
+                container.remove(force=True)
+            except Exception as e:
+                print(f"RefactoringMiner container {container.short_id} failed its health check: {e}")
+        return self.start_container()
+
+    def run_in_container(self, container, args):
+        command = [*self.entrypoint, *args]
+        if self.job_timeout:
+            command = ["timeout", "--signal=KILL", str(int(self.job_timeout)), *command]
+        user = f"{os.getuid()}:{os.getgid()}" if hasattr(os, "getuid") else "" # Output is owned by us, not root
+        start = time.monotonic()
+        exit_code, output = container.exec_run(command, user=user, environment=self.java_environment())
+        if exit_code == OUT_OF_MEMORY_EXIT_CODE and self.memory_limit:
+            raise self.out_of_memory()
+        if exit_code == TIMEOUT_EXIT_CODE or exit_code == 128 + 9:
+            if self.job_timeout and time.monotonic() - start >= self.job_timeout:
+                raise MinerJobTimeout(f"RefactoringMiner didn't finish in {self.job_timeout} seconds")
+            if self.memory_limit: # Killed by the container's memory limit
+                raise self.out_of_memory()
+        return exit_code
+
+    def run_locally(self, args):
+        try:
+            exit_code = subprocess.call(
+                [self.miner_path, *args],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=self.job_timeout,
+                env={**os.environ, **self.java_environment()}
+            )
+        except subprocess.TimeoutExpired:
+            raise MinerJobTimeout(f"RefactoringMiner didn't finish in {self.job_timeout} seconds")
+        if exit_code == OUT_OF_MEMORY_EXIT_CODE and self.memory_limit:
+            raise self.out_of_memory()
+        return exit_code
@@ -0,0 +1,109 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from repository import CACHE_DIR
+
+NLOC_CACHE_FILE = os.path.join(CACHE_DIR, "nloc.db")
+MAX_ENTRIES = 5_000_000
+FLUSH_INTERVAL = 1000
+
+def blob_id(content: bytes) -> str:
+    """
+    The id git gives a blob with this content
+
+    >>> blob_id(b"hello\\n")
+    'ce013625030ba8dba906f756967f9e9ca394464a'
+    """
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+class NlocCache(object):
+    """
+    Persistent blob id -> (nloc, language) cache. The same file content shows
+    up in many neighbouring commits and in forks of a project, keying on the
+    blob id means lizard only has to parse it once, also across runs.
+
+    New entries and hits are kept in memory and written in batches. When the
+    cache has more than max_entries rows the least recently used are dropped.
+
+    >>> cache = NlocCache(":memory:")
+    >>> cache.get("abc") is None
+    True
+    >>> cache.put("abc", 12, "Python")
+    >>> cache.get("abc")
+    (12, 'Python')
+    >>> cache.flush()
+    >>> cache.get("abc")
+    (12, 'Python')
+    """
+    def __init__(self, path=NLOC_CACHE_FILE, max_entries=MAX_ENTRIES):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.used = set()
+        # Worker processes of a commit traversal write to the same file
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS blobs (id TEXT PRIMARY KEY, nloc INTEGER, language TEXT, last_used REAL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used)")
+
+    def get(self, blob_id):
+        with self.lock:
+            if blob_id in self.pending:
+                return self.pending[blob_id]
+            row = self.connection.execute(
+                "SELECT nloc, language FROM blobs WHERE id = ?", (blob_id,)
+            ).fetchone()
+            if row:
+                self.used.add(blob_id)
+            return row
+
+    def put(self, blob_id, nloc, language):
+        with self.lock:
+            self.pending[blob_id] = (nloc, language)
+            should_flush = len(self.pending) + len(self.used) >= FLUSH_INTERVAL
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                [(id, nloc, language, now) for id, (nloc, language) in self.pending.items()]
+            )
+            self.connection.executemany(
+                "UPDATE blobs SET last_used = ? WHERE id = ?", [(now, id) for id in self.used]
+            )
+            self.pending.clear()
+            self.used.clear()
+
+            count = self.connection.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute(
+                    "DELETE FROM blobs WHERE id IN (SELECT id FROM blobs ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+shared_cache = None
+shared_cache_lock = threading.Lock()
+
+def get_shared_cache() -> NlocCache:
+    """
+    The cache every stage of this process uses, opened on first use
+    """
+    global shared_cache
+    with shared_cache_lock:
+        if shared_cache is None:
+            shared_cache = NlocCache()
+        return shared_cache
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -2,45 +2,202 @@ import subprocess
 import shutil
 import os
 import stat
-import re
+import threading
+import metrics
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "cache")
+
+# Mirrors that have a worktree checked out right now, these are never evicted
+mirrors_in_use = set()
+mirrors_lock = threading.Lock()
+# Disk size of every mirror when it was last measured
+mirror_sizes = {}
+
+def repository_name(url):
+    """
+    Name of the directory a repository is cloned into
+
+    >>> repository_name('https://github.com/apache/commons-lang.git')
+    'commons-lang'
+    """
+    name = url.rstrip("/").split("/")[-1]
+    return name[:-len(".git")] if name.endswith(".git") else name
+
+def mirror_path(repo_name, cache_dir=CACHE_DIR):
+    """
+    Path of the cached bare mirror of a repository, see Repository
+    """
+    return os.path.join(cache_dir, "mirrors", repo_name + ".git")
+
+def run_git(*args):
+    """
+    Run a git command quietly, raise with git's output if it fails
+    """
+    metrics.count("subprocesses")
+    result = subprocess.run(
+        ["git", *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True
+    )
+    if result.returncode != 0:
+        raise Exception(f"git {args[0]} failed: {result.stdout.strip()}")
+    return result.stdout
+
+def is_partial(repo_path):
+    """
+    Whether a repository is a partial clone that fetches blobs on demand
+    """
+    metrics.count("subprocesses")
+    command = ["git", "-C", repo_path, "config", "--get", "remote.origin.promisor"]
+    return subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True).stdout.strip() == "true"
+
+def fetch_missing_objects(repo_path):
+    """
+    Download every object a partial clone is missing in a single fetch, for
+    readers that can't fetch them on demand like RefactoringMiner's JGit.
+    Returns the number of objects that were missing.
+    """
+    metrics.count("subprocesses")
+    listing = subprocess.Popen(
+        ["git", "-C", repo_path, "rev-list", "--objects", "--all", "--missing=print"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True
+    )
+    missing = [line[1:].strip() for line in listing.stdout if line.startswith("?")]
+    listing.stdout.close()
+    if listing.wait() != 0:
+        raise Exception(f"git rev-list failed in {repo_path}")
+    if not missing:
+        return 0
+
+    # The same fetch git runs for a single missing object, with all of them at once
+    metrics.count("subprocesses")
+    result = subprocess.run(
+        ["git", "-C", repo_path, "-c", "fetch.negotiationAlgorithm=noop", "fetch", "--quiet", "origin", "--no-tags",
+            "--no-write-fetch-head", "--recurse-submodules=no", "--filter=blob:none", "--stdin"],
+        input="\n".join(missing),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True
+    )
+    if result.returncode != 0:
+        raise Exception(f"git fetch of {len(missing)} missing objects failed: {result.stdout.strip()}")
+    return len(missing)
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return size
+
+def remove_tree(path):
+    def remove_manually(func, path, _):
+        os.chmod(path, stat.S_IWRITE)
+        os.remove(path)
+
+    shutil.rmtree(path, onexc=remove_manually)
+
+def evict_mirrors(cache_dir, budget, changed_mirror=None):
+    """
+    Remove least recently used mirrors until the cache fits in budget bytes.
+    The size of every mirror is kept from when it was last measured, so
+    only changed_mirror, which was just fetched, is measured again. The
+    others are only measured again when the total goes over the budget.
+    """
+    mirror_dir = os.path.join(cache_dir, "mirrors")
+    if budget is None or not os.path.isdir(mirror_dir):
+        return
+
+    paths = [os.path.join(mirror_dir, name) for name in os.listdir(mirror_dir)]
+    with mirrors_lock:
+        unmeasured = [path for path in paths if path not in mirror_sizes or path == changed_mirror]
+    measured = {path: directory_size(path) for path in unmeasured} # Without the lock, clones go on meanwhile
+    with mirrors_lock:
+        mirror_sizes.update(measured)
+        if sum(mirror_sizes.get(path, 0) for path in paths) <= budget:
+            return
+
+    measured = {path: directory_size(path) for path in paths}
+    with mirrors_lock:
+        mirror_sizes.update(measured)
+        paths = [path for path in paths if os.path.isdir(path)] # Another repository may have evicted some meanwhile
+        total_size = sum(measured[path] for path in paths)
+        for path in sorted(paths, key=os.path.getmtime):
+            if total_size <= budget:
+                break
+            if path in mirrors_in_use:
+                continue
+            print(f"Evicting {os.path.basename(path)} from the mirror cache")
+            remove_tree(path)
+            total_size -= mirror_sizes.pop(path)
 
 class Repository(object):
     """
     Context manager class for git Repositories
-    Handles cloning and removing the directories
-    """
-    def __init__(self, url):
-        #Clone repo
-        clone_output = ""
-        p = subprocess.Popen(
-            ["git", "clone", url],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True
-        )
-
-        for line in iter(p.stdout.readline, ""):
-            print(line)
-            clone_output += line
-        p.stdout.close()
-        exit_code = p.wait()
-
-        if int(exit_code) != 0:
-            raise Exception("Problem while cloning repository from URL: " + url)
-
-        repo_name = re.search("Cloning into '(.*)'", clone_output).group(1)
-        current_dir = os.path.dirname(__file__)
+    Keeps a bare mirror of every repository in a local cache, which is only
+    updated with git fetch on later runs. A worktree is checked out from the
+    mirror for mining and removed afterwards.
+
+    With partial set, mirrors are cloned without file contents
+    (--filter=blob:none) and git downloads blobs as they are first needed.
+    The worktree is then a linked git worktree of the mirror, since a
+    partial mirror can't be cloned locally. Readers that can't download
+    blobs themselves need fetch_missing_objects first.
+
+    cache_budget is the disk size in bytes the mirrors may use, least
+    recently used mirrors are evicted when the cache grows over it.
+    """
+    def __init__(self, url, cache_dir=CACHE_DIR, partial=False, cache_budget=None):
+        repo_name = repository_name(url)
+        mirror = mirror_path(repo_name, cache_dir)
+        worktree_path = os.path.join(cache_dir, "worktrees", repo_name)
+
+        with mirrors_lock:
+            mirrors_in_use.add(mirror)
+
+        try:
+            if os.path.isdir(mirror):
+                run_git("-C", mirror, "fetch", "--quiet", "--prune", "origin")
+            else:
+                filter = ["--filter=blob:none"] if partial else []
+                run_git("clone", "--quiet", "--mirror", *filter, url, mirror)
+            os.utime(mirror) # Mark as recently used for eviction
+
+            if os.path.exists(worktree_path): # Left behind by an interrupted run
+                remove_tree(worktree_path)
+            run_git("-C", mirror, "worktree", "prune")
+            if partial:
+                run_git("-C", mirror, "worktree", "add", "--quiet", "--detach", worktree_path, "HEAD")
+            else:
+                # Objects are hardlinked, so the clone is fast and works on its own
+                # inside the RefactoringMiner container
+                run_git("clone", "--quiet", "--local", mirror, worktree_path)
+        except Exception as e:
+            with mirrors_lock:
+                mirrors_in_use.discard(mirror)
+            raise Exception(f"Problem while cloning repository from URL: {url} ({e})")
 
         self.repo_name = repo_name
-        self.directory_name = os.path.join(current_dir, repo_name)
+        self.directory_name = worktree_path
+        self.mirror_path = mirror
+        self.cache_dir = cache_dir
+        self.cache_budget = cache_budget
 
     def __enter__(self):
         return (self.directory_name, self.repo_name)
 
     def __exit__(self, type, value, traceback):
-        def remove_manually(func, path, _):
-            os.chmod(path, stat.S_IWRITE)
-            os.remove(path)
-
-        shutil.rmtree(self.directory_name, onexc=remove_manually)
+        remove_tree(self.directory_name)
+        run_git("-C", self.mirror_path, "worktree", "prune")
+        with mirrors_lock:
+            mirrors_in_use.discard(self.mirror_path)
+        evict_mirrors(self.cache_dir, self.cache_budget, self.mirror_path)
 
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
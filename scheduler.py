@@ -0,0 +1,49 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+
+class StageLimits(object):
+    """
+    Bounded concurrency limits for the different kinds of mining stages.
+    Network bound stages (cloning, fetching issues) and CPU bound stages
+    (RefactoringMiner, PyDriller) each get their own semaphore, so that
+    for example many clones can run while only a few miners are busy.
+
+    The commit traversal of a repository also gets a budget: the seconds it
+    may run and the megabytes each of its worker processes may use.
+
+    A limit of None means the stage kind is not limited at all.
+    """
+    def __init__(self, network_jobs=None, cpu_jobs=None, commits_timeout=None, commits_memory=None):
+        self.network = threading.BoundedSemaphore(network_jobs) if network_jobs else nullcontext()
+        self.cpu = threading.BoundedSemaphore(cpu_jobs) if cpu_jobs else nullcontext()
+        self.commits_timeout = commits_timeout
+        self.commits_memory = commits_memory
+
+NO_LIMITS = StageLimits()
+
+def run_parallel(job, items, workers):
+    """
+    Run job(item) for every item on a pool of worker threads.
+    A failing job only prints its error, like the sequential loop in
+    main.main() did, so one broken repository doesn't stop the others.
+
+    >>> results = []
+    >>> run_parallel(results.append, range(5), 3)
+    >>> sorted(results)
+    [0, 1, 2, 3, 4]
+    >>> run_parallel(lambda i: 1 / i, [0], 1)
+    0: division by zero
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(job, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"{futures[future]}: {e}")
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
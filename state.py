@@ -0,0 +1,157 @@
+import sqlite3
+import threading
+
+from datetime import datetime
+
+STAGES = ["rminer", "refactorings", "diffs", "effort", "issues", "links", "export"]
+FINISHED_STAGES_QUERY = (
+    "SELECT COUNT(*) FROM stages WHERE repository = ? AND head = ? "
+    f"AND stage IN ({', '.join('?' * len(STAGES))})"
+)
+
+class StateStore(object):
+    """
+    SQLite backed record of what has been mined for each repository.
+    For every stage the HEAD commit it has processed up to is stored, so a
+    rerun only has to look at commits after that and a half-finished
+    repository continues from the first stage that didn't finish.
+
+    >>> store = StateStore(":memory:")
+    >>> progress = store.progress("repo", "abc")
+    >>> progress.base("rminer") is None, progress.is_done("rminer")
+    (True, False)
+    >>> for stage in STAGES: progress.finish(stage)
+    >>> store.is_up_to_date("repo", "abc"), store.is_up_to_date("repo", "def")
+    (True, False)
+    >>> store.progress("repo", "def").base("diffs")
+    'abc'
+
+    A repository mined before a stage existed is up to date only once that
+    stage ran too:
+    >>> for stage in STAGES[:-1]: store.progress("old", "abc").finish(stage)
+    >>> _ = store.connection.execute("INSERT INTO repositories VALUES ('old', 'abc', '')") # Mined with fewer STAGES
+    >>> store.is_up_to_date("old", "abc")
+    False
+
+    Repositories that ran past a stage's budget are deferred, what they
+    finished stays recorded:
+    >>> store.defer("big", "https://github.com/apache/big", "rminer", "timed out")
+    >>> store.is_deferred("big"), store.deferred_urls()
+    (True, ['https://github.com/apache/big'])
+    >>> store.undefer("big")
+    >>> store.deferred_urls()
+    []
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock() # One connection is shared by all worker threads
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS repositories (name TEXT PRIMARY KEY, head TEXT, mined_at TEXT)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS stages ("
+                "repository TEXT, stage TEXT, head TEXT, finished_at TEXT, PRIMARY KEY (repository, stage))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS deferred ("
+                "repository TEXT PRIMARY KEY, url TEXT, stage TEXT, reason TEXT, deferred_at TEXT)"
+            )
+
+    def last_head(self, repo_name):
+        """
+        HEAD of the last fully mined version of the repository
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT head FROM repositories WHERE name = ?", (repo_name,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def stage_head(self, repo_name, stage):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT head FROM stages WHERE repository = ? AND stage = ?", (repo_name, stage)
+            ).fetchone()
+        return row[0] if row else None
+
+    def finish_stage(self, repo_name, stage, head):
+        now = datetime.now().isoformat()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?)", (repo_name, stage, head, now)
+            )
+            finished = self.connection.execute(FINISHED_STAGES_QUERY, (repo_name, head, *STAGES)).fetchone()[0]
+            if finished == len(STAGES):
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO repositories VALUES (?, ?, ?)", (repo_name, head, now)
+                )
+
+    def is_up_to_date(self, repo_name, head):
+        """
+        Whether every stage finished at head, stages added to STAGES after
+        the repository was mined still have to run
+        """
+        if head is None:
+            return False
+        with self.lock:
+            finished = self.connection.execute(FINISHED_STAGES_QUERY, (repo_name, head, *STAGES)).fetchone()[0]
+        return finished == len(STAGES)
+
+    def defer(self, repo_name, url, stage, reason):
+        """
+        Leave a repository for a later run without budgets
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO deferred VALUES (?, ?, ?, ?, ?)",
+                (repo_name, url, stage, reason, datetime.now().isoformat())
+            )
+
+    def undefer(self, repo_name):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM deferred WHERE repository = ?", (repo_name,))
+
+    def is_deferred(self, repo_name):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT 1 FROM deferred WHERE repository = ?", (repo_name,)
+            ).fetchone() is not None
+
+    def deferred_urls(self):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT url FROM deferred ORDER BY deferred_at")]
+
+    def progress(self, repo_name, head):
+        return RepositoryProgress(self, repo_name, head)
+
+class RepositoryProgress(object):
+    """
+    The stages of one mining run of a repository, which mines up to head
+    """
+    def __init__(self, store, repo_name, head):
+        self.store = store
+        self.repo_name = repo_name
+        self.head = head
+
+    def base(self, stage):
+        """
+        Commit the stage was previously mined up to, None if never
+        """
+        return self.store.stage_head(self.repo_name, stage)
+
+    def is_done(self, stage):
+        """
+        Whether the stage was mined up to head, never if head is unknown
+
+        >>> StateStore(":memory:").progress("repo", None).is_done("issues")
+        False
+        """
+        return self.head is not None and self.base(stage) == self.head
+
+    def finish(self, stage):
+        self.store.finish_stage(self.repo_name, stage, self.head)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
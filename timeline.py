@@ -0,0 +1,173 @@
+import os
+
+from array import array
+
+import numpy as np
+
+TIMELINE_FILE = "timeline.npz"
+PERCENTILES = (50, 90, 99)
+DAY = 24 * 60 * 60
+
+class TimelineBuilder(object):
+    """
+    Collects refactorings one at a time into compact arrays, types and
+    authors are stored as codes into their lists of names
+    """
+    def __init__(self):
+        self.timestamps = array("q")
+        self.type_codes = array("i")
+        self.author_codes = array("i")
+        self.types = {}
+        self.authors = {}
+
+    def add(self, timestamp, type, author):
+        self.timestamps.append(int(timestamp))
+        self.type_codes.append(self.types.setdefault(type, len(self.types)))
+        self.author_codes.append(self.authors.setdefault(author, len(self.authors)))
+
+    def build(self):
+        return Timeline(
+            np.frombuffer(self.timestamps, dtype=np.int64) if self.timestamps else np.zeros(0, np.int64),
+            np.frombuffer(self.type_codes, dtype=np.int32) if self.type_codes else np.zeros(0, np.int32),
+            np.frombuffer(self.author_codes, dtype=np.int32) if self.author_codes else np.zeros(0, np.int32),
+            list(self.types),
+            list(self.authors)
+        )
+
+class Timeline(object):
+    """
+    The refactorings of a repository as parallel arrays: commit time in
+    epoch seconds, refactoring type code and author code. Every statistic
+    is computed with array operations, not per refactoring in Python.
+
+    >>> builder = TimelineBuilder()
+    >>> for timestamp, type, author in [(0, "Rename", "a"), (10, "Move", "a"), (30, "Rename", "b"), (100, "Rename", "a")]:
+    ...     builder.add(timestamp, type, author)
+    >>> timeline = builder.build()
+    >>> timeline.intervals().tolist(), timeline.intervals("Rename").tolist()
+    ([10, 20, 70], [30, 70])
+    >>> timeline.interval_percentiles((50,))
+    {'Rename': [50.0]}
+    >>> timeline.rolling_rate(window=50).tolist()
+    [1, 2, 3, 1]
+    >>> bursts = timeline.bursts(gap=15)
+    >>> bursts["author"].tolist(), bursts["size"].tolist(), bursts["start"].tolist(), bursts["end"].tolist()
+    (['a', 'a', 'b'], [2, 1, 1], [0, 100, 30], [10, 100, 30])
+    """
+    def __init__(self, timestamps, type_codes, author_codes, types, authors):
+        self.timestamps = timestamps
+        self.type_codes = type_codes
+        self.author_codes = author_codes
+        self.types = types
+        self.authors = authors
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            timestamps=self.timestamps,
+            type_codes=self.type_codes,
+            author_codes=self.author_codes,
+            types=np.array(self.types, dtype=str),
+            authors=np.array(self.authors, dtype=str)
+        )
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            return Timeline(
+                data["timestamps"], data["type_codes"], data["author_codes"],
+                data["types"].tolist(), data["authors"].tolist()
+            )
+
+    def intervals(self, type=None):
+        """
+        Seconds between consecutive refactorings, of one type if given
+        """
+        timestamps = self.timestamps if type is None else self.timestamps[self.type_codes == self.types.index(type)]
+        return np.diff(np.sort(timestamps))
+
+    def intervals_by_type(self):
+        """
+        Type codes and intervals of all types at once: sorted by type and
+        time, an interval counts where both ends have the same type
+        """
+        order = np.lexsort((self.timestamps, self.type_codes))
+        codes = self.type_codes[order]
+        same_type = codes[1:] == codes[:-1]
+        return codes[1:][same_type], np.diff(self.timestamps[order])[same_type]
+
+    def interval_percentiles(self, percentiles=PERCENTILES):
+        """
+        Percentiles of the seconds between refactorings of each type, for
+        types that occur at least twice
+        """
+        codes, intervals = self.intervals_by_type()
+        return {
+            self.types[code]: np.percentile(intervals[codes == code], percentiles).tolist()
+            for code in np.unique(codes)
+        }
+
+    def rolling_rate(self, window=30 * DAY):
+        """
+        For every refactoring in time order, how many refactorings happened
+        in the window of seconds up to and including it
+        """
+        timestamps = np.sort(self.timestamps)
+        return np.arange(1, len(timestamps) + 1) - np.searchsorted(timestamps, timestamps - window, side="right")
+
+    def bursts(self, gap=DAY):
+        """
+        Runs of refactorings by the same author with at most gap seconds
+        between them, as arrays of author, size, start and end time
+        """
+        order = np.lexsort((self.timestamps, self.author_codes))
+        authors = self.author_codes[order]
+        timestamps = self.timestamps[order]
+        starts = np.ones(len(order), dtype=bool)
+        starts[1:] = (authors[1:] != authors[:-1]) | (np.diff(timestamps) > gap)
+        start_indexes = np.flatnonzero(starts)
+        return {
+            "author": np.array(self.authors, dtype=str)[authors[start_indexes]] if len(order) else np.zeros(0, str),
+            "size": np.diff(np.append(start_indexes, len(order))),
+            "start": timestamps[start_indexes],
+            "end": np.maximum.reduceat(timestamps, start_indexes) if len(order) else np.zeros(0, np.int64)
+        }
+
+    def summary(self, percentiles=PERCENTILES):
+        """
+        Numbers for refactorings.json, interval percentiles in seconds
+        """
+        intervals = self.intervals()
+        values = np.percentile(intervals, percentiles).tolist() if len(intervals) else [None] * len(percentiles)
+        return {f"p{percentile}": value for percentile, value in zip(percentiles, values)}
+
+def load_timelines(output_root):
+    """
+    Yield (repository, timeline) for every repository with a timeline
+    """
+    for repo_name in sorted(os.listdir(output_root)):
+        path = os.path.join(output_root, repo_name, TIMELINE_FILE)
+        if os.path.exists(path):
+            yield repo_name, Timeline.load(path)
+
+def interval_percentiles_across(output_root, percentiles=PERCENTILES):
+    """
+    Percentiles of the seconds between refactorings of each type over every
+    repository, intervals never cross from one repository to another
+    """
+    intervals_by_type = {}
+    for _, timeline in load_timelines(output_root):
+        codes, intervals = timeline.intervals_by_type()
+        for code in np.unique(codes):
+            intervals_by_type.setdefault(timeline.types[code], []).append(intervals[codes == code])
+    return {
+        type: np.percentile(np.concatenate(intervals), percentiles).tolist()
+        for type, intervals in intervals_by_type.items()
+    }
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,20 +1,97 @@
 import csv
+import os
+import zlib
 
-def list_project_urls(filename):
+SONAR_MEASURES_FILE = "./sonar_measures.csv"
+PROJECT_COLUMN = "project"
+INDEX_SUFFIX = ".projects"
+
+def list_project_urls(filename=SONAR_MEASURES_FILE, shard=None):
+    """
+    URLs of the unique projects in the measures file, sorted so that every
+    machine gets the same list. With shard ("i/n") only that share of them.
+    """
     print("Finding all unique projects...")
-    with open(filename, newline='') as repositories:
-        reader = csv.DictReader(repositories)
-        projects = find_unique_projects(reader)
-        print("There are", len(projects), "unique projects.\n")
-        urls = map(to_url, projects)
-        return urls
+    projects = find_unique_projects(filename)
+    print("There are", len(projects), "unique projects.\n")
+    urls = sorted(set(map(to_url, projects))) # apache_x and x are the same repository
+    if shard:
+        urls = select_shard(urls, shard)
+        print(f"Shard {shard} has {len(urls)} of them.\n")
+    return urls
+
+def find_unique_projects(filename):
+    """
+    Sorted unique project names. They are read from an index file next to
+    the measures file, which is written on first use and rebuilt when the
+    measures file changes.
+    """
+    index_path = filename + INDEX_SUFFIX
+    stat = os.stat(filename)
+    signature = f"{stat.st_size} {stat.st_mtime_ns}"
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as index_file:
+            if index_file.readline().rstrip("\n") == signature:
+                return index_file.read().splitlines()
 
-def find_unique_projects(csv):
+    projects = sorted(read_projects(filename))
+    try:
+        with open(index_path + ".tmp", "w", encoding="utf-8") as index_file:
+            index_file.write(signature + "\n")
+            index_file.writelines(project + "\n" for project in projects)
+        os.replace(index_path + ".tmp", index_path)
+    except OSError as e: # A read-only directory only costs the index
+        print(f"Couldn't write the project index {index_path}: {e}")
+    return projects
+
+def read_projects(filename):
+    """
+    Distinct values of the project column. Rows are read as plain lists and
+    only the project column is kept, no dict is built per row.
+    """
     projects = set()
-    for line in csv:
-        projects.add(line["project"])
+    with open(filename, newline='') as repositories:
+        reader = csv.reader(repositories)
+        column = next(reader).index(PROJECT_COLUMN)
+        for row in reader:
+            if len(row) > column:
+                projects.add(row[column])
+    projects.discard("")
     return projects
 
+def select_shard(urls, shard):
+    """
+    The URLs of shard "i/n" (0 <= i < n). A URL always lands in the same
+    shard, also when projects are added to the list, so the shards of
+    several machines never overlap and together cover every URL.
+
+    >>> urls = [to_url(f"project-{i}") for i in range(100)]
+    >>> shards = [select_shard(urls, f"{i}/3") for i in range(3)]
+    >>> sorted(sum(shards, [])) == sorted(urls)
+    True
+    >>> select_shard(urls, "1/3") == select_shard(urls[::-1], "1/3")[::-1]
+    True
+    """
+    index, count = parse_shard(shard)
+    return [url for url in urls if zlib.crc32(url.encode()) % count == index]
+
+def parse_shard(shard):
+    """
+    >>> parse_shard("2/4")
+    (2, 4)
+    >>> parse_shard("4/4")
+    Traceback (most recent call last):
+    ...
+    ValueError: shard must be i/n with 0 <= i < n, got 4/4
+    """
+    try:
+        index, count = map(int, shard.split("/"))
+    except ValueError:
+        index, count = -1, 0
+    if not 0 <= index < count:
+        raise ValueError(f"shard must be i/n with 0 <= i < n, got {shard}")
+    return index, count
+
 def to_url(project):
     """
     Parses a project name into a clonable GitHub URL under the Apache organization.
@@ -0,0 +1,183 @@
+import multiprocessing
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+from git import GitCommandError
+from pydriller import Git
+
+from cost import OverBudget
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+CHUNK_SIZE = 16 # Commits per process pool task
+
+class Collector(object):
+    """
+    Something computed from commits. The traversal hands every commit in
+    hashes to extract, which returns a record for store. extract only looks
+    at the commit and store writes the record out, so a collector's output
+    streams as the commits are visited.
+
+    With a process pool extract runs in the worker processes on a copy of
+    the collector, and its records are pickled back to store, in order.
+    flush is called in the worker after every batch of commits.
+
+    A collector is a context manager around the traversal, finish is called
+    when every commit has been visited and isn't if the traversal failed.
+    """
+    stage = None # The state store stage the collector finishes
+
+    def __init__(self, hashes):
+        self.hashes = dict.fromkeys(hashes) # Ordered, for a stable output order
+
+    def extract(self, commit):
+        raise NotImplementedError
+
+    def store(self, record):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.finish()
+
+def traverse(repo_path, collectors, processes=1, timeout=None, memory_limit=None):
+    """
+    Visit every commit any of the collectors wants once, and give each
+    commit to the collectors that want it, in the order of their hashes
+    whether or not a process pool is used. With more than one process the
+    commits are extracted by a process pool, whose processes may use
+    memory_limit megabytes each, the git commands they start included.
+
+    A traversal running longer than timeout seconds, or a process running
+    out of its memory, raises OverBudget. The records stored until then are
+    kept, but no collector is finished. A budget is only enforced on a pool,
+    which is then used even for one process, so a commit still running at
+    the deadline is given up with its process.
+    """
+    wanted_hashes = {}
+    for collector in collectors:
+        wanted_hashes.update(collector.hashes)
+    if not wanted_hashes:
+        return
+
+    if processes > 1 or timeout or memory_limit:
+        with parallel_extractor(repo_path, collectors, max(processes, 1), memory_limit, timeout) as extract_all, \
+                ExitStack() as stack:
+            for collector in collectors:
+                stack.enter_context(collector)
+            for collector_index, record in extract_all(list(wanted_hashes)):
+                collectors[collector_index].store(record)
+        return
+
+    with ExitStack() as stack:
+        for collector in collectors:
+            stack.enter_context(collector)
+
+        # Commits are looked up one by one like on the pool, so records are stored in the same order
+        gr = Git(repo_path)
+        for commit_hash in wanted_hashes:
+            commit = gr.get_commit(commit_hash)
+            for collector in collectors:
+                if commit_hash in collector.hashes:
+                    collector.store(collector.extract(commit))
+
+#PROCESS POOL
+# State of a worker process, set up once by start_worker
+worker_git = None
+worker_collectors = None
+
+def start_worker(repo_path, collectors, open_lock, memory_limit=None):
+    global worker_git, worker_collectors
+    # The git commands the worker starts inherit the limit, each of them may use as much. Only
+    # allocated memory counts, not address space, which git's memory-mapped packs would fill up.
+    if memory_limit and resource is not None:
+        limit = memory_limit * 1024 ** 2
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+    with open_lock: # PyDriller writes the repository's config when it opens it
+        worker_git = Git(repo_path)
+    worker_collectors = collectors
+
+def extract_chunk(hashes):
+    """
+    Records of a chunk of commits as (collector index, record) pairs
+    """
+    records = []
+    for commit_hash in hashes:
+        commit = worker_git.get_commit(commit_hash)
+        for index, collector in enumerate(worker_collectors):
+            if commit_hash in collector.hashes:
+                records.append((index, collector.extract(commit)))
+    for collector in worker_collectors:
+        collector.flush()
+    return records
+
+class parallel_extractor(object):
+    """
+    A process pool that extracts the records of a list of commits in order.
+    Only a bounded number of chunks is in flight at a time, so memory
+    doesn't grow with the number of commits. Waiting for a chunk past the
+    deadline, or a worker that dies or fails under its memory limit, raises
+    OverBudget, and the workers are stopped without finishing their chunks.
+    """
+    def __init__(self, repo_path, collectors, processes, memory_limit=None, timeout=None):
+        # Not forked, this process runs threads that a fork would copy mid-flight
+        context = multiprocessing.get_context("spawn")
+        self.executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=context,
+            initializer=start_worker,
+            initargs=(repo_path, collectors, context.Lock(), memory_limit)
+        )
+        self.max_in_flight = processes * 2
+        self.memory_limit = memory_limit
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    def __enter__(self):
+        return self.extract_all
+
+    def __exit__(self, type, value, traceback):
+        if type is not None: # Don't wait for a commit that may run for hours
+            for process in list(self.executor._processes.values()):
+                process.terminate()
+        self.executor.shutdown(cancel_futures=True)
+
+    def result(self, future):
+        remaining = max(0, self.deadline - time.monotonic()) if self.deadline else None
+        try:
+            return future.result(timeout=remaining)
+        except TimeoutError:
+            raise OverBudget("commits", f"The commit traversal didn't finish in {self.timeout} seconds")
+        except MemoryError:
+            raise OverBudget("commits", f"A commit worker ran out of its {self.memory_limit} MB")
+        except (BrokenProcessPool, GitCommandError, RuntimeError) as e: # RuntimeError if a thread's stack doesn't fit
+            if not self.memory_limit:
+                raise
+            raise OverBudget("commits", f"A commit worker failed under its {self.memory_limit} MB limit ({e})")
+
+    def extract_all(self, hashes):
+        chunks = iter([hashes[start:start + CHUNK_SIZE] for start in range(0, len(hashes), CHUNK_SIZE)])
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append(self.executor.submit(extract_chunk, chunk))
+            if len(in_flight) == self.max_in_flight:
+                break
+        while in_flight:
+            yield from self.result(in_flight.popleft())
+            if (chunk := next(chunks, None)) is not None:
+                in_flight.append(self.executor.submit(extract_chunk, chunk))
@@ -2,23 +2,35 @@ import matplotlib.pyplot as plt
 import os
 import json
 import re
-from datetime import timedelta, datetime
+import numpy as np
+from datetime import timedelta
+from metrics import read_metrics
+from timeline import interval_percentiles_across
 
 OUTPUT_ROOT_DIR = "./output"
 REFACTORING_FILE = "refactorings.json"
-PROGRAM_LOG_FILE = "./program_output.txt"
-LINE_TIME_PREFIX_RE = "(?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+) - "
-
-LOG_REGEX_SEQUENCE = [
-    r"Running RefactoringMiner...",
-    r"Parsing output from RefactoringMiner...",
-    r"Collecting diffs...",
-    r"Collecting developer effort...",
-    r"Mining issue data...",
-    r"Success!",
-]
+STAGE_LABELS = {
+    "clone": "Clone",
+    "rminer": "RefactoringMiner",
+    "parse": "Refactoring type sum and time average",
+    "diffs": "Commit diff calculation",
+    "effort": "Dev effort collection",
+    "commits": "Commit diffs and dev effort",
+    "issues": "Issue data collection",
+    "links": "Commit issue linking",
+    "export": "Columnar export",
+}
 
 def get_time_from_str(time_str):
+    """
+    Parse a str(timedelta), for refactorings.json files written before the
+    average was also stored in seconds
+
+    >>> get_time_from_str("1 day, 2:03:04.500000").total_seconds()
+    93784.0
+    >>> get_time_from_str("0:00:59").total_seconds()
+    59.0
+    """
     match = re.search(
         r"(?:(?P<days>\d+) day[s]?, )?(?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+)(?:.(?P<milliseconds>\d+))?",
         time_str
@@ -28,80 +40,34 @@ def get_time_from_str(time_str):
         days=days,
         hours=int(match.group("hours")),
         minutes=int(match.group("minutes")),
-        seconds=int(match.group("minutes"))
+        seconds=int(match.group("seconds"))
     )
 
 
 def estimate_mining_time_division():
     """
-    Go through log file line by line to estimate the time taken by each mining step
-    and total mining time. Try to find a matching line for previously matched line.
-    If a non matching line is found, return to sequence index zero and start over.
+    Sum up the time taken by each mining step and the total mining time from
+    the stage metrics written by main.py, one line per mined repository.
     """
-    step_time_sum = [timedelta() for i in range(0, 5)] #Indices are diffrent steps in the mining process
-    total_time = timedelta()
+    step_time_sum = {stage: 0.0 for stage in STAGE_LABELS}
+    total_time = 0.0
     time_per_project = {}
 
-    with open(PROGRAM_LOG_FILE, "r") as log_file:
-        current_project_name = None
-        log_sequence_index = 0
-        time_for_step = None
-        previous_time = None
-        for line in log_file.readlines():
-            if project_name := re.search("Mining the (.*) repository...", line):
-                current_project_name = project_name.group(1)
-
-            if re_match := re.search(
-                LINE_TIME_PREFIX_RE + LOG_REGEX_SEQUENCE[log_sequence_index], line
-            ):
-                action_time = datetime(1, 1, 1, int(re_match['hours']), int(re_match["minutes"]), int(re_match["seconds"]))
-                if previous_time:
-                    time_for_step = action_time - previous_time
-                    if time_for_step < timedelta(): #Step happened over midnight
-                        #Horrible way to do this but whatever. assume no step takes over 24 hours
-                        action_time = action_time = datetime(1, 1, 2, int(re_match['hours']), int(re_match["minutes"]), int(re_match["seconds"]))
-                        time_for_step = action_time - previous_time
-
-                    time_per_project[current_project_name] = time_per_project.get(current_project_name, timedelta()) + time_for_step
-                    total_time += time_for_step
-                    step_time_sum[log_sequence_index - 1] += time_for_step
-                
-                if log_sequence_index == 5: #start over on success
-                    log_sequence_index = 0
-                    previous_time = None
-                    continue
-
-                log_sequence_index += 1
-                previous_time = action_time
-            
-            #If line is found in the sequence but isn't the correct one reset index
-            elif re.sub(LINE_TIME_PREFIX_RE, "", line) in LOG_REGEX_SEQUENCE:
-                log_sequence_index = 0
-                previous_time = None
-                
-    print(step_time_sum)
-
-    labels = [
-        "RefactoringMiner", 
-        "Refactoring type sum and time average",
-        "Commit diff calculation",
-        "Dev effort collection",
-        "Issue data collection"
-    ]
-
-    time_object = {
-        labels[0]:  step_time_sum[0].total_seconds(),
-        labels[1]:  step_time_sum[1].total_seconds(),
-        labels[2]:  step_time_sum[2].total_seconds(),
-        labels[3]:  step_time_sum[3].total_seconds(),
-        labels[4]: step_time_sum[4].total_seconds(),
-        "total_time": total_time.total_seconds()
-    } 
+    for record in read_metrics():
+        for stage, stage_metrics in record["stages"].items():
+            step_time_sum[stage] = step_time_sum.get(stage, 0.0) + stage_metrics["seconds"]
+        time_per_project[record["repository"]] = time_per_project.get(record["repository"], 0.0) + record["total_seconds"]
+        total_time += record["total_seconds"]
+
+    time_object = {STAGE_LABELS.get(stage, stage): seconds for stage, seconds in step_time_sum.items()}
+    time_object["total_time"] = total_time
 
     print(json.dumps(time_object))
 
+    # Stages no repository ran, like diffs and effort since they are collected as commits, have no slice
+    plotted = {stage: seconds for stage, seconds in step_time_sum.items() if seconds > 0}
     ax = plt.subplot()
-    ax.pie([i.total_seconds() for i in step_time_sum], labels=labels)
+    ax.pie(plotted.values(), labels=[STAGE_LABELS.get(stage, stage) for stage in plotted])
     plt.show()
 
     time_for_refactor = []
@@ -114,7 +80,7 @@ def estimate_mining_time_division():
                 for val in refactorings.values():
                     sum += val
                 
-                time_for_refactor.append((sum, value.total_seconds()))
+                time_for_refactor.append((sum, value))
 
 
         except Exception as e:
@@ -135,10 +101,12 @@ def draw_and_save_inter_commit_time_histogram():
         try:
             with open(f"{OUTPUT_ROOT_DIR}/{dir}/{REFACTORING_FILE}", "r") as refactoring_file:
                 json_obj = json.loads(refactoring_file.read())
-                average_refactor_time = json_obj['average_time_between_refactors']
-                time = get_time_from_str(average_refactor_time)
+                if 'average_seconds_between_refactors' in json_obj:
+                    seconds = json_obj['average_seconds_between_refactors']
+                else:
+                    seconds = get_time_from_str(json_obj['average_time_between_refactors']).total_seconds()
 
-                average_times.append((time.total_seconds() / 60) / 60)
+                average_times.append((seconds / 60) / 60)
         except Exception as e:
             print(e)
     
@@ -158,8 +126,31 @@ def draw_and_save_inter_commit_time_histogram():
 
 
 
+def draw_interval_percentiles_by_type(top=20):
+    """
+    Median and 90th percentile of the time between refactorings of each
+    type over every repository's timeline, for the top types with the
+    shortest median
+    """
+    percentiles = interval_percentiles_across(OUTPUT_ROOT_DIR, (50, 90))
+    types = sorted(percentiles, key=lambda type: percentiles[type][0])[:top]
+    medians = np.array([percentiles[type][0] for type in types]) / 3600
+    p90s = np.array([percentiles[type][1] for type in types]) / 3600
+    positions = np.arange(len(types))
+
+    ax = plt.subplot()
+    ax.barh(positions, p90s, color="pink", edgecolor="black", label="90th percentile")
+    ax.barh(positions, medians, color="purple", edgecolor="black", label="Median")
+    ax.set_yticks(positions, types)
+    plt.xscale("log")
+    plt.xlabel("Time between refactors of the type in hours")
+    plt.legend()
+    plt.show()
+
+
 def main():
     #draw_and_save_inter_commit_time_histogram()
+    #draw_interval_percentiles_by_type()
     estimate_mining_time_division()
 
 
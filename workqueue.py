@@ -0,0 +1,317 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+
+MAX_ATTEMPTS = 3
+LEASE_SECONDS = 15 * 60
+POLL_SECONDS = 30
+
+class SqliteQueue(object):
+    """
+    Queue of repository URLs in an SQLite file that the coordinator and the
+    workers of every node open, for example on shared storage with working
+    file locks. A worker claims a URL with a lease that it renews while it
+    mines. A lease that runs out, because its node died, puts the URL back
+    in the queue, and a URL that failed or expired max_attempts times is
+    failed for good.
+
+    >>> queue = SqliteQueue(":memory:", max_attempts=2)
+    >>> queue.add(["a", "b"])
+    >>> queue.claim("node-1", 60), queue.claim("node-2", 0)
+    ('a', 'b')
+    >>> queue.claim("node-1", 60) # The lease of node-2 ran out
+    'b'
+    >>> queue.fail("b", "node-1", "broken")
+    >>> queue.complete("a", "node-1")
+    >>> sorted(queue.counts().items())
+    [('done', 1), ('failed', 1)]
+    """
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock() # One connection is shared by the worker threads
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=60, isolation_level=None)
+        with self.transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "url TEXT PRIMARY KEY, state TEXT, worker TEXT, lease_expires REAL, attempts INTEGER, error TEXT)"
+            )
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction that takes the database lock at its start, so two
+        nodes can't claim the same URL
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def add(self, urls):
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO jobs VALUES (?, 'queued', NULL, NULL, 0, NULL)", [(url,) for url in urls]
+            )
+
+    def reap(self, connection=None):
+        """
+        Put URLs whose lease ran out back in the queue
+        """
+        if connection is None:
+            with self.transaction() as connection:
+                return self.reap(connection)
+        connection.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+            "error = 'lease of ' || worker || ' expired', worker = NULL "
+            "WHERE state = 'leased' AND lease_expires < ?",
+            (self.max_attempts, time.time())
+        )
+
+    def claim(self, worker, lease_seconds=LEASE_SECONDS):
+        """
+        Lease the next URL to worker, None if nothing is queued
+        """
+        with self.transaction() as connection:
+            self.reap(connection)
+            row = connection.execute(
+                "SELECT url FROM jobs WHERE state = 'queued' ORDER BY attempts, rowid LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE url = ?",
+                (worker, time.time() + lease_seconds, row[0])
+            )
+            return row[0]
+
+    def renew(self, url, worker, lease_seconds=LEASE_SECONDS):
+        """
+        Extend the lease, False if the worker doesn't hold it anymore
+        """
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE url = ? AND worker = ? AND state = 'leased'",
+                (time.time() + lease_seconds, url, worker)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, url, worker):
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET state = 'done', worker = NULL, error = NULL WHERE url = ? AND worker = ?", (url, worker)
+            )
+
+    def fail(self, url, worker, error):
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, worker = NULL, error = ? "
+                "WHERE url = ? AND worker = ?",
+                (self.max_attempts, error, url, worker)
+            )
+
+    def counts(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+# Pops the next URL and leases it in one step, so a crash can't lose it
+REDIS_CLAIM_SCRIPT = """
+local url = redis.call('LPOP', KEYS[1])
+if not url then return nil end
+redis.call('ZADD', KEYS[2], ARGV[1], url)
+redis.call('HSET', KEYS[3], url, 'leased')
+redis.call('HSET', KEYS[4], url, ARGV[2])
+redis.call('HINCRBY', KEYS[5], url, 1)
+return url
+"""
+# KEYS: states, queue. ARGV: the URLs. A URL is marked queued and pushed together or not at all.
+REDIS_ADD_SCRIPT = """
+for _, url in ipairs(ARGV) do
+    if redis.call('HSETNX', KEYS[1], url, 'queued') == 1 then
+        redis.call('RPUSH', KEYS[2], url)
+    end
+end
+"""
+# KEYS: leases, workers, errors, attempts, states, queue. ARGV: url, error, max attempts.
+# Only the node that removes the lease requeues the URL.
+REDIS_REQUEUE_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then return 0 end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+if tonumber(redis.call('HGET', KEYS[4], ARGV[1]) or 0) >= tonumber(ARGV[3]) then
+    redis.call('HSET', KEYS[5], ARGV[1], 'failed')
+else
+    redis.call('HSET', KEYS[5], ARGV[1], 'queued')
+    redis.call('RPUSH', KEYS[6], ARGV[1])
+end
+return 1
+"""
+
+class RedisQueue(object):
+    """
+    The same queue on a Redis server, or anything speaking its protocol.
+    Needs the redis package, the SQLite queue is the stand-in without it.
+    Every change of a URL's state runs as one Lua script or MULTI block, so
+    a node dying halfway never leaves a URL queued but missing from the list
+    or leased without a lease.
+    """
+    def __init__(self, url, name="miner", max_attempts=MAX_ATTEMPTS):
+        import redis
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.max_attempts = max_attempts
+        self.queue, self.leases, self.states, self.workers, self.attempts, self.errors = (
+            f"{name}:{key}" for key in ("queue", "leases", "states", "workers", "attempts", "errors")
+        )
+        self.claim_script = self.redis.register_script(REDIS_CLAIM_SCRIPT)
+        self.add_script = self.redis.register_script(REDIS_ADD_SCRIPT)
+        self.requeue_script = self.redis.register_script(REDIS_REQUEUE_SCRIPT)
+
+    def add(self, urls):
+        urls = list(urls)
+        if urls:
+            self.add_script(keys=[self.states, self.queue], args=urls)
+
+    def requeue(self, url, error):
+        """
+        Take a leased URL back and put it in the queue, or fail it when it has
+        no attempts left. False if its lease was already taken back.
+        """
+        keys = [self.leases, self.workers, self.errors, self.attempts, self.states, self.queue]
+        return bool(self.requeue_script(keys=keys, args=[url, error, self.max_attempts]))
+
+    def reap(self):
+        for url in self.redis.zrangebyscore(self.leases, "-inf", time.time()):
+            self.requeue(url, f"lease of {self.redis.hget(self.workers, url)} expired")
+
+    def claim(self, worker, lease_seconds=LEASE_SECONDS):
+        self.reap()
+        keys = [self.queue, self.leases, self.states, self.workers, self.attempts]
+        return self.claim_script(keys=keys, args=[time.time() + lease_seconds, worker])
+
+    def holds(self, url, worker):
+        return self.redis.hget(self.workers, url) == worker and self.redis.hget(self.states, url) == "leased"
+
+    def renew(self, url, worker, lease_seconds=LEASE_SECONDS):
+        if not self.holds(url, worker):
+            return False
+        self.redis.zadd(self.leases, {url: time.time() + lease_seconds}, xx=True)
+        return True
+
+    def complete(self, url, worker):
+        if self.holds(url, worker):
+            with self.redis.pipeline(transaction=True) as pipeline:
+                pipeline.zrem(self.leases, url)
+                pipeline.hdel(self.workers, url)
+                pipeline.hset(self.states, url, "done")
+                pipeline.execute()
+
+    def fail(self, url, worker, error):
+        if self.holds(url, worker):
+            self.requeue(url, error)
+
+    def counts(self):
+        return dict(Counter(self.redis.hvals(self.states)))
+
+def open_queue(location, max_attempts=MAX_ATTEMPTS):
+    """
+    A redis:// (or rediss://) URL opens a Redis queue, anything else is the
+    path of an SQLite queue
+    """
+    if location.startswith(("redis://", "rediss://")):
+        return RedisQueue(location, max_attempts=max_attempts)
+    return SqliteQueue(location, max_attempts)
+
+@contextmanager
+def heartbeat(queue, url, worker, lease_seconds):
+    """
+    Keep renewing the lease of url while the block runs
+    """
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(lease_seconds / 3):
+            if not queue.renew(url, worker, lease_seconds):
+                print(f"Lost the lease of {url}, another worker may mine it too")
+                return
+
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        renewer.join()
+
+def run_worker(queue, job, worker, threads, lease_seconds=LEASE_SECONDS, poll_seconds=POLL_SECONDS):
+    """
+    Claim URLs and run job(url) for them on threads threads until the
+    queue is empty and nothing is leased. A failing job is retried, maybe
+    by another node, until it runs out of attempts.
+    """
+    def work(thread_worker):
+        while True:
+            url = queue.claim(thread_worker, lease_seconds)
+            if url is None:
+                counts = queue.counts()
+                if not counts.get("queued") and not counts.get("leased"):
+                    return
+                time.sleep(poll_seconds) # Leases of other nodes may still run out
+                continue
+
+            try:
+                with heartbeat(queue, url, thread_worker, lease_seconds):
+                    job(url)
+            except Exception as e:
+                print(f"{url}: {e}")
+                queue.fail(url, thread_worker, str(e))
+            else:
+                queue.complete(url, thread_worker)
+
+    workers = [threading.Thread(target=work, args=(f"{worker}/{index}",)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+def run_coordinator(queue, urls, poll_seconds=POLL_SECONDS):
+    """
+    Queue the URLs and report progress until every one is done or failed
+    """
+    queue.add(urls)
+    while True:
+        queue.reap()
+        counts = queue.counts()
+        print(f"{time.strftime('%H:%M:%S')} - " + ", ".join(f"{state}: {count}" for state, count in sorted(counts.items())))
+        if not counts.get("queued") and not counts.get("leased"):
+            return counts
+        time.sleep(poll_seconds)
+
+def upload(output_dir, destination_root):
+    """
+    Copy a repository's output directory to destination_root, replacing an
+    earlier upload. The copy is made next to the destination first, so
+    readers only ever see a complete upload.
+    """
+    from repository import remove_tree
+    destination = os.path.join(destination_root, os.path.basename(os.path.normpath(output_dir)))
+    for leftover in (destination + ".uploading", destination + ".old"):
+        if os.path.exists(leftover):
+            remove_tree(leftover)
+    shutil.copytree(output_dir, destination + ".uploading")
+    if os.path.exists(destination):
+        os.rename(destination, destination + ".old")
+    os.rename(destination + ".uploading", destination)
+    if os.path.exists(destination + ".old"):
+        remove_tree(destination + ".old")
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()